@@ -0,0 +1,174 @@
+from __future__ import division
+import numpy as np
+import clues_utils
+from clues_engine import CluesEngine
+from clues import read_prune_file
+import warnings
+import argparse
+
+warnings.filterwarnings("ignore")
+
+parser = argparse.ArgumentParser(description=
+                'Runs CLUES on every SNP listed in a manifest, loading the conditional '+
+                'transition file once and each popFreq bin of it once, and writes '+
+                'one table of results.')
+# mandatory inputs:
+parser.add_argument('manifest',type=str,help='whitespace-separated rows of: treesFile posn popFreq [derivedAllele]; lines starting with # are skipped')
+parser.add_argument('conditionalTrans',type=str,help='an .hdf5 file that specifies the conditional transition probabilities and stationary frequency distn, as well as metadata (or a directory, as in clues.py)')
+parser.add_argument('sitesFile',type=str,help='The data file used as input to sample ARGs in ARGweaver (.sites format)')
+parser.add_argument('-o','--output',dest='outFile',type=str,required=True,help='tab-separated table with one row per manifest row')
+
+# options (as in clues.py):
+parser.add_argument('-timeScale','--timeScale',type=float,default=1)
+parser.add_argument('-q','--quiet',action='store_true')
+parser.add_argument('-derivedAllele','--derivedAllele',type=str,help='derived allele for manifest rows that do not give one',default='G')
+parser.add_argument('-ancientHap','--ancientHap',type=str,default='0')
+parser.add_argument('-noAncientHap','--noAncientHap',action='store_true')
+parser.add_argument('-debug','--debug',action='store_true')
+parser.add_argument('-thin','--thin',type=int,default=5)
+parser.add_argument('--burnin',type=int,default=0)
+parser.add_argument('-ssv','--ssv',action='store_true')
+parser.add_argument('--selCoeff',type=float,default=None)
+parser.add_argument('--tSel',type=float,default=None)
+parser.add_argument('-prune','--prune',type=str,default=None)
+parser.add_argument('--invar',action='store_true')
+parser.add_argument('--statDistn',action='store_true')
+parser.add_argument('--prior',action='store_true')
+parser.add_argument('--sampleBatch',type=int,default=None)
+parser.add_argument('--workers',type=int,default=1)
+parser.add_argument('--lazyTrans',action='store_true')
+parser.add_argument('--marginals',type=str,choices=['all','best','none'],default='none',help='the table only holds LRs, so by default no marginals are computed')
+parser.add_argument('--margThreshold',type=float,default=None)
+parser.add_argument('--essTol',type=float,default=None)
+parser.add_argument('--seTol',type=float,default=None)
+parser.add_argument('--minSamples',type=int,default=10)
+parser.add_argument('--seed',type=int,default=0)
+parser.add_argument('--coarseStep',type=int,default=None)
+parser.add_argument('--bothBins',action='store_true')
+parser.add_argument('--argweaverLog',type=str,default=None,help='with a trans_dir/ conditionalTrans')
+parser.add_argument('--noSkip',action='store_true')
+parser.add_argument('--tSelMax',type=float,default=10000)
+parser.add_argument('--approx',type=float,default=500)
+
+TABLE_COLUMNS = ['treesFile','posn','popFreq','derivedAllele','popFreqIdx','freqBin',
+			'numSamples','numWronglyPolarized','sHat','tHat','logLR','ssvLogLR','ess','seLogLR','gridPointsEvaluated']
+
+def read_manifest(manifestFile,derivedAllele='G'):
+	## rows of (treesFile, posn, popFreq, derivedAllele)
+	rows = []
+	for line in open(manifestFile,'r'):
+		cols = line.split()
+		if len(cols) == 0 or cols[0][0] == '#':
+			continue
+		if len(cols) > 3:
+			allele = cols[3]
+		else:
+			allele = derivedAllele
+		rows.append((cols[0],int(cols[1]),float(cols[2]),allele))
+	return rows
+
+def score_manifest(engine,rows,args):
+	'''
+	Scores every manifest row; rows are grouped by discretized popFreq
+	index so that each trans_dpfi slice is read once. Returns one table
+	row per manifest row, in manifest order.
+	'''
+	if args.noAncientHap:
+		ancientHap = None
+	else:
+		ancientHap = args.ancientHap
+	indsToPrune = read_prune_file(args.prune)
+	if args.essTol != None or args.seTol != None:
+		seed = args.seed
+	else:
+		seed = None
+
+	## popFreqs are discretized in manifest order, before any grouping;
+	## with bothBins, rows are grouped by their pair of bins, and the
+	## table gives the nearer one
+	if args.bothBins:
+		popFreqBins = [engine.neighbouring_bins(popFreq) for (_,_,popFreq,_) in rows]
+		groups = [tuple(bins) for (bins,_) in popFreqBins]
+		popFreqIdxs = [bins[np.argmax(weights)] for (bins,weights) in popFreqBins]
+	else:
+		popFreqIdxs = [engine.discretize_pop_freq(popFreq) for (_,_,popFreq,_) in rows]
+		groups = popFreqIdxs
+	## bins missing from conditionalTrans are found before any scoring; their
+	## rows are written with NaN results, as are the rows that cannot be scored
+	missingBins = dict([(group,[dpfi for dpfi in np.atleast_1d(group) if not engine.TRANS_STORE.has_bin(dpfi)]) for group in set(groups)])
+	table = [None for _ in rows]
+	for r in sorted(range(len(rows)),key=lambda r: groups[r]):
+		treesFile,posn,popFreq,derivedAllele = rows[r]
+		dpfi = popFreqIdxs[r]
+		if len(missingBins[groups[r]]) > 0:
+			if not args.quiet:
+				print('%s\t%d: popFreq bin %d is not in %s'%(treesFile,posn,missingBins[groups[r]][0],args.conditionalTrans))
+			table[r] = list(rows[r]) + [dpfi,engine.FREQS[dpfi]] + [np.nan for _ in TABLE_COLUMNS[6:]]
+			continue
+		if args.bothBins:
+			binArgs = {'popFreq':popFreq,'bothBins':True}
+		else:
+			binArgs = {'discretizedPopFreqIdx':dpfi}
+		derInds,ancInds,ancHap = clues_utils.derived_carriers_from_sites(args.sitesFile,
+								posn,
+								derivedAllele=derivedAllele,
+								ancientHap=ancientHap,
+								invar=args.invar)
+		treeSamples = clues_utils.read_tree_samples(treesFile,burnin=args.burnin,thin=args.thin,seed=seed)
+		try:
+			res = engine.score(treeSamples,derInds,ancInds,ancHap,
+						ssv=args.ssv,
+						selCoeff=args.selCoeff,
+						tSel=args.tSel,
+						indsToPrune=indsToPrune,
+						prior=args.prior,
+						marginals=args.marginals,
+						margThreshold=args.margThreshold,
+						essTol=args.essTol,
+						seTol=args.seTol,
+						minSamples=args.minSamples,
+						coarseStep=args.coarseStep,
+						**binArgs)
+		except NotImplementedError as e:
+			if not args.quiet:
+				print('%s\t%d: %s'%(treesFile,posn,e))
+			table[r] = list(rows[r]) + [dpfi,engine.FREQS[dpfi]] + [np.nan for _ in TABLE_COLUMNS[6:]]
+			continue
+		logLikelihoodRatios = res['logLikelihoodRatios']
+		lr = logLikelihoodRatios[res['iHat'],res['jHat']]
+		if args.ssv:
+			ssvLr = lr - np.max(logLikelihoodRatios[:,-1])
+		else:
+			ssvLr = np.nan
+		table[r] = list(rows[r]) + [dpfi,engine.FREQS[dpfi],
+				res['numImportanceSamples'],res['numSamplesWronglyPolarized'],
+				res['sHat'],res['tHat'],lr,ssvLr,res['effectiveSampleSize'],res['seLogLR'],np.sum(res['gridEvaluated'])]
+		if not args.quiet:
+			print('%s\t%d\ts = %s\tlr = %f'%(treesFile,posn,str(res['sHat']),lr))
+	return table
+
+def write_table(outFile,table):
+	f = open(outFile,'w')
+	f.write('\t'.join(TABLE_COLUMNS)+'\n')
+	for row in table:
+		f.write('%s\t%d\t%.6f\t%s\t%d\t%.6f\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n'%tuple(row))
+	f.close()
+	return
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	engine = CluesEngine(args.conditionalTrans,
+				approx=args.approx,
+				timeScale=args.timeScale,
+				statDistn=args.statDistn,
+				sampleBatch=args.sampleBatch,
+				workers=args.workers,
+				lazyTrans=args.lazyTrans,
+				transDirLog=args.argweaverLog,
+				noSkip=args.noSkip,
+				transDirSsv=args.ssv,
+				transDirTSelMax=args.tSelMax,
+				debug=args.debug)
+	rows = read_manifest(args.manifest,derivedAllele=args.derivedAllele)
+	table = score_manifest(engine,rows,args)
+	write_table(args.outFile,table)
@@ -0,0 +1,950 @@
+from __future__ import division
+import numpy as np
+from scipy.special import logsumexp
+from scipy.optimize import minimize_scalar
+import scipy.stats as stats
+import clues_utils
+import transition_store
+import multiprocessing
+import itertools
+import h5py
+import json
+import os
+
+## default sampleBatch with lazyTrans
+LAZY_SAMPLE_BATCH = 32
+
+class CluesEngine(object):
+	'''
+	Scores sites against one conditional transition file, which is opened
+	once; the cached emission rows are shared by every site it scores:
+
+		engine = CluesEngine('conditional_trans.hdf5')
+		res = engine.score(clues_utils.read_tree_samples('site.trees'),derInds,ancInds,ancHap,popFreq)
+	'''
+
+	def __init__(self,conditionalTrans,approx=500,timeScale=1,statDistn=False,sampleBatch=None,workers=1,lazyTrans=False,
+			transBuilder=None,transDirLog=None,noSkip=False,transDirSsv=False,transDirTSelMax=10000,debug=False):
+		self.conditionalTrans = conditionalTrans
+		## conditionalTrans may be an unconditioned trans_dir/, conditioned at
+		## load time (see transition_store.TransDirTransitionStore)
+		self.transDirLog = transDirLog
+		self.noSkip = noSkip
+		self.transDirSsv = transDirSsv
+		self.transDirTSelMax = transDirTSelMax
+		self.timeScale = timeScale
+		self.statDistn = statDistn
+		## lazily read epochs are read again for every batch, so lazyTrans
+		## defaults to larger batches
+		if sampleBatch == None:
+			sampleBatch = LAZY_SAMPLE_BATCH if lazyTrans else 1
+		self.sampleBatch = sampleBatch
+		self.workers = workers
+		self.lazyTrans = lazyTrans
+		## transition_store.TransitionBuilder, for continuous s
+		self.TRANS_BUILDER = transBuilder
+		self.debug = debug
+		self.load_hdf5()
+		if transBuilder != None:
+			freqs = transBuilder.freqs
+			if freqs.shape != self.FREQS.shape or not np.allclose(freqs,self.FREQS):
+				raise ValueError('the %d frequency bins of the trans_dir/ matrices do not match the %d of %s'%(len(freqs),len(self.FREQS),conditionalTrans))
+		self.popsize = self.SAMPLING_POPSIZE
+		self.ds = np.diff(self.AW_TIMES)
+		self.GRIFFITHS_TAVARE_CHANGEPOINT = np.digitize(approx,self.AW_TIMES)
+		self.EMISSION_INDEX = {}
+		self.EMISSION_ROWS = {}
+		self.TRANS_CACHE = {}
+		self.ALPHA_BUFFER = None
+		self.BETA_BUFFER = None
+
+	def load_hdf5(self):
+		samplingTrans = transition_store.open_store(self.conditionalTrans,logFile=self.transDirLog,noSkip=self.noSkip,ssv=self.transDirSsv,tSelMax=self.transDirTSelMax)
+		self.AW_TIMES = samplingTrans.attrs['t']
+		CALC_N = 2000
+		self.SAMPLING_POPSIZE = samplingTrans.attrs['popsize']
+		if self.statDistn:
+			self.SAMPLING_STAT_DISTN = samplingTrans.stat_distn()
+		else:
+			self.SAMPLING_STAT_DISTN = None
+		self.I_SEL = samplingTrans.attrs['iSel']
+		self.S_GRID = samplingTrans.attrs['sGrid']
+		self.FREQS = samplingTrans.attrs['freqs']
+		## generate breaks from freqs
+		breaks = [0,1/CALC_N]
+		for (i,freq) in enumerate(self.FREQS[1:-2]):
+			nextBreak = freq + freq - breaks[i+1]
+			breaks.append(nextBreak)
+		breaks += [1-1/CALC_N,1]
+		self.BREAKS = np.array(breaks)
+		self.BIN_SIZES = np.diff(breaks[1:-1])
+		self.NG = len(self.FREQS)
+		self.TRANS_STORE = samplingTrans
+		return
+
+	def close(self):
+		self.TRANS_STORE.close()
+		return
+
+	def __getstate__(self):
+		## pool workers get the engine without its open hdf5 handles; the
+		## transition tensor they need is passed with the job
+		state = self.__dict__.copy()
+		for key in ['SAMPLING_STAT_DISTN','TRANS_CACHE','ALPHA_BUFFER','BETA_BUFFER','TRANS_BUILDER']:
+			state[key] = None
+		return state
+
+	def discretize_pop_freq(self,popFreq):
+		## randomized rounding of popFreq to one of its two neighbouring bins
+		FREQS = self.FREQS
+		if popFreq != 1:
+			discretizedPopFreqIdx = np.digitize(popFreq,FREQS)
+			hPlus = FREQS[discretizedPopFreqIdx]-popFreq
+			hMinus = popFreq - FREQS[discretizedPopFreqIdx-1]
+			sign = -1*np.random.binomial(1,hPlus/(hPlus+hMinus))
+			discretizedPopFreqIdx += sign
+		else:
+			discretizedPopFreqIdx = len(FREQS)-1
+		return discretizedPopFreqIdx
+
+	def neighbouring_bins(self,popFreq):
+		## the bins either side of popFreq, with the probabilities that
+		## discretize_pop_freq rounds to each (one bin if popFreq is on it)
+		FREQS = self.FREQS
+		if popFreq == 1:
+			return [len(FREQS)-1],[1.]
+		hi = np.digitize(popFreq,FREQS)
+		for dpfi in [hi-1,hi]:
+			if np.isclose(popFreq,FREQS[dpfi]):
+				return [dpfi],[1.]
+		hPlus = FREQS[hi]-popFreq
+		hMinus = popFreq - FREQS[hi-1]
+		return [hi-1,hi],[hPlus/(hPlus+hMinus),hMinus/(hPlus+hMinus)]
+
+	def sampling_grid(self,discretizedPopFreqIdx,ssv=False,selCoeff=None,tSel=None):
+		'''
+		(s, t_sel) grid of a job: returns the s and t_sel indices into the
+		transition store, and the grid itself (sGrid, iSel)
+		'''
+		S_GRID = self.S_GRID
+		I_SEL = self.I_SEL
+		if not ssv:
+			## the last t_sel column of the file is the sweep that starts before AW_TIMES[-1]
+			I_TRANS_SEL = [len(I_SEL) - 1]
+			I_SEL = [I_SEL[-1]]
+			if selCoeff == None:
+				I_S = [_ for _ in range(len(S_GRID))]
+			else:
+				I_S = np.digitize([1e-5,selCoeff],S_GRID)
+				S_GRID = [S_GRID[_] for _ in I_S]
+		else:
+			if selCoeff == None:
+				I_S = [_ for _ in range(len(S_GRID))]
+			else:
+				I_S = np.digitize([1e-5,selCoeff],S_GRID)
+			if tSel == None:
+				I_SEL = list(range(0,self.TRANS_STORE.trans_shape(discretizedPopFreqIdx)[1]-1))+[-1]
+			else:
+				I_SEL = [np.digitize(tSel,self.AW_TIMES)-1]
+			I_TRANS_SEL = I_SEL
+			S_GRID = [S_GRID[_] for _ in I_S]
+		return list(I_S),list(I_TRANS_SEL),list(S_GRID),list(I_SEL)
+
+	def sampling_trans(self,discretizedPopFreqIdx,ssv=False,selCoeff=None,tSel=None):
+		'''
+		(s, t_sel, epochs, NG, NG) transition tensor of the job's grid at the
+		popFreq bin, returned with sGrid and iSel; the last one read is cached.
+		'''
+		key = (discretizedPopFreqIdx,ssv,selCoeff,tSel)
+		if key in self.TRANS_CACHE:
+			return self.TRANS_CACHE[key]
+		I_S,I_TRANS_SEL,S_GRID,I_SEL = self.sampling_grid(discretizedPopFreqIdx,ssv=ssv,selCoeff=selCoeff,tSel=tSel)
+		SAMPLING_TRANS = self.TRANS_STORE.read_trans(discretizedPopFreqIdx,I_S,I_TRANS_SEL,lazy=self.lazyTrans)
+		if not self.TRANS_STORE.cachesTrans:
+			self.TRANS_CACHE = {key:(SAMPLING_TRANS,S_GRID,I_SEL)}
+		return (SAMPLING_TRANS,S_GRID,I_SEL)
+
+	def stacked_sampling_trans(self,discretizedPopFreqIdxs,ssv=False,selCoeff=None,tSel=None):
+		'''
+		The sampling_trans tensors of several popFreq bins, read in full and
+		stacked along the s axis (bin by bin), so that one pass over the
+		samples scores every bin
+		'''
+		key = (tuple(discretizedPopFreqIdxs),ssv,selCoeff,tSel)
+		if key in self.TRANS_CACHE:
+			return self.TRANS_CACHE[key]
+		if isinstance(self.TRANS_STORE,transition_store.TransDirTransitionStore):
+			## all the bins conditioned in one pass over the s matrices
+			self.TRANS_STORE.condition_bins(discretizedPopFreqIdxs)
+		blocks = []
+		for discretizedPopFreqIdx in discretizedPopFreqIdxs:
+			I_S,I_TRANS_SEL,S_GRID,I_SEL = self.sampling_grid(discretizedPopFreqIdx,ssv=ssv,selCoeff=selCoeff,tSel=tSel)
+			blocks.append(self.TRANS_STORE.read_trans(discretizedPopFreqIdx,I_S,I_TRANS_SEL))
+		SAMPLING_TRANS = np.concatenate(blocks,axis=0)
+		if not self.TRANS_STORE.cachesTrans:
+			self.TRANS_CACHE = {key:(SAMPLING_TRANS,S_GRID,I_SEL)}
+		return (SAMPLING_TRANS,S_GRID,I_SEL)
+
+	def get_coal_times_all_classes(self,nwk,derInds,ancInds,ancHap,indsToPrune=[]):
+		'''
+		Coalescence times (in generations) of the derived, ancestral and mixed
+		subtrees of one tree; classes that are not tracked for this (n, m)
+		partition are returned as None
+		'''
+		n = len(derInds)
+		m = len(ancInds)
+		timeScale = self.timeScale
+		derTimes,ancTimes,mixTimes = None,None,None
+		if ancHap == None:
+			ancHap = []
+		if n >= 2 and m >= 2:
+			derTimes,ancTimes,mixTimes = [timeScale * times for times in clues_utils.coal_times_by_class(nwk,
+								[ancInds + ancHap + indsToPrune,
+								derInds + ancHap + indsToPrune,
+								derInds[1:] + ancHap + indsToPrune])]
+			if self.debug:
+				print(derTimes)
+
+		elif n == 1 and m >= 2:
+			ancTimes,mixTimes = [timeScale * times for times in clues_utils.coal_times_by_class(nwk,
+								[derInds + ancHap + indsToPrune,
+								derInds[1:] + ancHap + indsToPrune])]
+
+		elif n >= 2 and m == 1:
+			derTimes,mixTimes = [timeScale * times for times in clues_utils.coal_times_by_class(nwk,
+								[ancInds + ancHap + indsToPrune,
+								derInds[1:] + ancHap + indsToPrune])]
+		elif n == 0 and m >= 2:
+			[ancTimes] = [timeScale * times for times in clues_utils.coal_times_by_class(nwk,[ancHap + indsToPrune])]
+
+		elif n >= 2 and m == 0:
+			[derTimes] = [timeScale * times for times in clues_utils.coal_times_by_class(nwk,[ancHap + indsToPrune])]
+
+		else:
+			raise NotImplementedError('no lineage classes for n = %d, m = %d'%(n,m))
+
+		return derTimes,ancTimes,mixTimes
+
+	def lineage_counts(self,classTimes,n,m,eps=None):
+		'''
+		Bins the coalescence times of every sample (a list of (der, anc, mix)
+		time arrays, see get_coal_times_all_classes) against AW_TIMES in one
+		call; returns an int array of shape (samples, len(AW_TIMES), 3)
+		'''
+		if eps is None:
+			eps = branch_count_eps(n,m)
+		maxCoal = max([len(times) for sampleTimes in classTimes for times in sampleTimes if times is not None] + [0])
+		coalTimes = np.inf * np.ones((len(classTimes),3,maxCoal))
+		for (k,sampleTimes) in enumerate(classTimes):
+			for (l,times) in enumerate(sampleTimes):
+				if times is not None:
+					coalTimes[k,l,:len(times)] = times
+		C = np.moveaxis(clues_utils.branch_counts_array(coalTimes,self.AW_TIMES,eps=eps),1,2)
+		## classes that are not tracked hold a fixed count
+		if n == 1:
+			C[:,:,0] = 1
+		elif n == 0:
+			C[:,:,0] = 0
+		if m == 1:
+			C[:,:,1] = 1
+		elif m == 0:
+			C[:,:,1] = 0
+		if n == 0:
+			C[:,:,2] = C[:,:,1]
+		elif m == 0:
+			C[:,:,2] = 1
+		return np.ascontiguousarray(C)
+
+	def emission_rows(self,l,e,A,B):
+		'''
+		Rows for a[i] -> b[i] lineages of the lazily filled emission cache of
+		class l (0: derived, 1: ancestral, 2: mixed) over epoch e:
+		EMISSION_INDEX[(l,e)] maps (a, b) to its row of EMISSION_ROWS[(l,e)],
+		log P(a -> b) at every frequency bin; a < 2 gives the zero row 0.
+		'''
+		N = self.popsize[e]
+		Npop = [N*self.FREQS,N*(1-self.FREQS),N][l]
+		key = (l,e)
+		if key not in self.EMISSION_INDEX:
+			self.EMISSION_INDEX[key] = {}
+			self.EMISSION_ROWS[key] = np.zeros((1,) + np.shape(Npop))
+		index = self.EMISSION_INDEX[key]
+		pairs,inv = np.unique(np.stack((A,B),axis=1),axis=0,return_inverse=True)
+		pairs = [tuple(pair) for pair in pairs.tolist()]
+		## nothing coalesces with 0 or 1 lineages; those map to row 0
+		new = np.array([pair for pair in pairs if pair[0] > 1 and pair not in index],dtype=int).reshape(-1,2)
+		if len(new) > 0:
+			isTavare = e+1>self.GRIFFITHS_TAVARE_CHANGEPOINT
+			rows = clues_utils.log_coal_count_rows(new[:,0],new[:,1],self.ds[e],Npop,isTavare)
+			start = len(self.EMISSION_ROWS[key])
+			self.EMISSION_ROWS[key] = np.concatenate((self.EMISSION_ROWS[key],rows))
+			for (j,pair) in enumerate(new.tolist()):
+				index[tuple(pair)] = start + j
+		rowIdx = np.array([index.get(pair,0) for pair in pairs])
+		return self.EMISSION_ROWS[key][rowIdx[inv.ravel()]]
+
+	def log_emission_vector(self,e,C0,C1):
+		## log-likelihood of the lineage counts over epoch e, for every sample
+		## and frequency bin; C0, C1 are (samples x 3) counts at the start and end
+		Cder0,Canc0,Cmix0 = C0.T
+		Cder1,Canc1,Cmix1 = C1.T
+		val = self.emission_rows(0,e,Cder0,Cder1) + self.emission_rows(1,e,Canc0,Canc1)
+		## structured after the mutation
+		val[(Cmix1 == Canc1) & (Cder0 > 0),1:] = -np.inf
+		## x = 0: only the mixed process, once the derived lineages have coalesced
+		val[:,0] = np.where(Cmix0 == 1,0,self.emission_rows(2,e,Cmix0,Cmix1))
+		val[Cder1 > 1,0] = -np.inf
+		val[np.isnan(val) | np.isinf(val)] = -np.inf
+		return val
+
+	def lookup_alpha(self,i,i_coal,trans,C0,C1,alpha=0):
+		localTrans = trans[...,i,:,:]
+
+		coal_vec = self.log_emission_vector(i_coal,C0,C1)
+		coal_vec = coal_vec.reshape(coal_vec.shape[:1] + (1,)*(trans.ndim-3) + coal_vec.shape[1:])
+		val = coal_vec + clues_utils.log_vecmat(alpha,localTrans)
+
+		return val
+
+	def lookup_beta(self,i,i_coal,trans,C0,C1,beta=0):
+		localTrans = trans[...,i,:,:]
+
+		coal_vec = self.log_emission_vector(i_coal,C0,C1)
+		coal_vec = coal_vec.reshape(coal_vec.shape[:1] + (1,)*(trans.ndim-3) + coal_vec.shape[1:])
+		val = clues_utils.log_matvec(localTrans,coal_vec + beta)
+		return val
+
+	def recursion_buffers(self,numSamples,gridShape):
+		'''
+		(samples, s, t_sel, epochs+1, NG) buffers for the alpha and beta of
+		every epoch; they are allocated once and reused by every batch with
+		the same grid, so memory stays fixed however many samples are run
+		'''
+		shape = (numSamples,) + tuple(gridShape) + (len(self.ds)+1,self.NG)
+		if self.ALPHA_BUFFER is None or self.ALPHA_BUFFER.shape[0] < numSamples or self.ALPHA_BUFFER.shape[1:] != shape[1:]:
+			self.ALPHA_BUFFER = np.empty(shape)
+			self.BETA_BUFFER = np.empty(shape)
+		return self.ALPHA_BUFFER[:numSamples],self.BETA_BUFFER[:numSamples]
+
+	def backward_algorithm(self,C,trans,n,m,discretizedPopFreqIdx,betas=None):
+		'''
+		Backward recursion for a batch of samples at every (s, t_sel) grid point
+		of trans at once; returns the (samples,...) log-likelihoods and fills
+		betas if given. discretizedPopFreqIdx may list one bin per s row.
+		'''
+		ds = self.ds
+		C0 = np.tile(initial_counts(n,m),(len(C),1))
+		for i in range(1,len(ds)+1):
+			if i == 1:
+				if np.ndim(discretizedPopFreqIdx) == 0:
+					beta = trans[...,0,:,discretizedPopFreqIdx]
+				else:
+					beta = np.stack([trans[i_s,...,0,:,dpfi] for (i_s,dpfi) in enumerate(discretizedPopFreqIdx)])
+				beta = np.broadcast_to(beta,(len(C),)+beta.shape)
+			else:
+				if i > 2:
+					C0 = C[:,i-2,:]
+				C1 = C[:,i-1,:]
+				beta = self.lookup_beta(i-1,i-2,trans,C0,C1,beta=beta)
+			if betas is not None:
+				betas[...,i,:] = beta
+		return beta[...,0]
+
+	def forward_algorithm(self,C,trans,n,m,alphas):
+		'''
+		Runs the forward recursion for a batch of samples at every grid point
+		of trans at once (see backward_algorithm for the layout of C and
+		trans); the alpha of epoch i is written to alphas[...,i,:].
+		'''
+		ds = self.ds
+		for i in range(len(ds)-1,-1,-1):
+			if i == len(ds)-1:
+				alpha = alphas[...,i+1,:]
+				alpha[...] = -np.inf
+				alpha[...,0] = 0
+			if i == 0:
+				localTrans = trans[...,i,:,:]
+				alphas[...,0,:] = clues_utils.log_vecmat(alpha,localTrans)
+				continue
+			elif i == 1:
+				C0 = np.tile(initial_counts(n,m),(len(C),1))
+			else:
+				C0 = C[:,i-2,:]
+			C1 = C[:,i-1,:]
+			alphas[...,i,:] = self.lookup_alpha(i,i-1,trans,C0,C1,alpha=alpha)
+			alpha = alphas[...,i,:]
+		return alphas
+
+	def score_batch(self,nwks,trans,n,m,discretizedPopFreqIdx,derInds,ancInds,ancHap,indsToPrune,statDistnTerm,margs=True):
+		'''
+		Pushes one batch of trees through the HMM at every grid point of
+		trans; returns the (s, t_sel, samples) log-likelihoods, the
+		(samples, s, t_sel, epochs, NG) marginals (None without margs, in
+		which case the forward pass is skipped) and the validity mask
+		'''
+		ds = self.ds
+		## (samples x epochs x 3) lineage counts (derived, ancestral, mixed)
+		C = self.lineage_counts([self.get_coal_times_all_classes(nwk,derInds,ancInds,ancHap,indsToPrune) for nwk in nwks],n,m)
+		## conduct importance sampling to find sHat, tHat;
+		## every (s, t_sel) grid point is evaluated in a single pass
+		if margs:
+			alphas,betas = self.recursion_buffers(len(nwks),trans.shape[:-3])
+		else:
+			betas = None
+		logLikelihoods = self.backward_algorithm(C,trans,n,m,discretizedPopFreqIdx,betas=betas)
+		if statDistnTerm is not None:
+			logLikelihoods += statDistnTerm
+
+		isValid = ~(np.isinf(logLikelihoods) | np.isnan(logLikelihoods))
+		logLikelihoods[~isValid] = -np.inf
+		batchLogLRs = np.moveaxis(logLikelihoods,0,-1)
+		if not margs:
+			return batchLogLRs,None,isValid
+
+		self.forward_algorithm(C,trans,n,m,alphas)
+		batchMargEsts = np.zeros((len(nwks),)+trans.shape[:-3]+(len(ds),self.NG))
+		for j in range(len(ds)):
+			if j != 0:
+				marg = alphas[...,j,:] + betas[...,j,:]
+			else:
+				marg = alphas[...,j,:]
+			marg = marg - logsumexp(marg,axis=-1,keepdims=True)
+			batchMargEsts[:,:,:,j,:][isValid] = marg[isValid]
+		return batchLogLRs,batchMargEsts,isValid
+
+	def run_samples(self,treeSamples,job,S_GRID,I_SEL,margs=True,verbose=True,logWeights=None,polarized=None,start=None,onBatch=None):
+		'''
+		Scores the samples sampleBatch at a time (in a pool with workers) and
+		returns the (s, t_sel, samples) log-LRs, the marginal accumulator and the
+		correctly polarized samples. start resumes from a checkpoint; scoring
+		stops once onBatch returns True.
+		'''
+		AW_TIMES = self.AW_TIMES
+		idxsSamplesCorrectlyPolarized = []
+		individualLogLRs = []
+		margAcc = None
+		kStart = 0
+		if start != None:
+			individualLogLRs = [start['logImportanceWeights']]
+			idxsSamplesCorrectlyPolarized = list(np.nonzero(start['polarized'])[0])
+			margAcc = start['margAcc']
+			kStart = start['logImportanceWeights'].shape[-1]
+			treeSamples = itertools.islice(treeSamples,kStart,None)
+		if self.sampleBatch > 0:
+			batchSize = self.sampleBatch
+		else:
+			batchSize = None
+		job = job + (margs,)
+		batches = clues_utils.batched(treeSamples,batchSize)
+		pool = None
+		if self.workers > 1 and batchSize != None:
+			if isinstance(job[0],transition_store.EpochSlabTrans):
+				## workers get the whole tensor, read once here
+				job = (job[0].read_all(),) + job[1:]
+			pool = multiprocessing.Pool(self.workers,initializer=init_worker,initargs=(self,job))
+			results = pool.imap(score_batch_in_worker,batches)
+		else:
+			results = (self.score_batch(nwks,*job) for nwks in batches)
+		try:
+			for (batchLogLRs,batchMargEsts,isValid) in results:
+				kEnd = kStart + batchLogLRs.shape[-1]
+				individualLogLRs.append(batchLogLRs)
+				if margs:
+					if logWeights is None:
+						with np.errstate(invalid='ignore'):
+							batchLogWeights = batchLogLRs - batchLogLRs[0,0,:]
+					else:
+						batchLogWeights = logWeights[:,:,kStart:kEnd]
+					if polarized is None:
+						batchPolarized = isValid[:,0,0]
+					else:
+						batchPolarized = polarized[kStart:kEnd]
+					margAcc = self.accumulate_marginals(margAcc,batchMargEsts,batchLogWeights,batchPolarized)
+
+				for kk in range(kStart,kEnd):
+					if self.debug and verbose:
+						for (i_s,s) in enumerate(S_GRID):
+							for (ii_sel,i_sel) in enumerate(I_SEL):
+								print('s: %.5f,\ttSel: %d,\t logL: %.3f'%(s,AW_TIMES[i_sel],batchLogLRs[i_s,ii_sel,kk-kStart]))
+					if not isValid[kk-kStart,0,0]:
+						if self.debug and verbose:
+							print('Sample %d:\tIncorrect polarization'%(kk))
+						continue
+					idxsSamplesCorrectlyPolarized += [kk]
+
+					if self.debug and verbose:
+						# most likely value of s, i_sel for this sample
+						imax = np.unravel_index(batchLogLRs[:,:,kk-kStart].argmax(), batchLogLRs[:,:,kk-kStart].shape)
+						print('Sample %d:\t%.6f\t%.1f\t%.3f'%(kk,S_GRID[imax[0]],AW_TIMES[imax[1]],np.max(batchLogLRs[:,:,kk-kStart])))
+				kStart = kEnd
+				if onBatch != None and onBatch(individualLogLRs,margAcc,idxsSamplesCorrectlyPolarized,kEnd):
+					break
+		finally:
+			if pool != None:
+				pool.terminate()
+				pool.join()
+
+		individualLogLRs = np.concatenate([np.zeros((len(S_GRID),len(I_SEL),0))] + individualLogLRs,axis=-1)
+		individualLogLRs[np.where(np.isnan(individualLogLRs))] = -np.inf
+		if margs and margAcc is None:
+			margAcc = -np.inf * np.ones((len(S_GRID),len(I_SEL),len(self.ds),self.NG))
+		return individualLogLRs,margAcc,idxsSamplesCorrectlyPolarized
+
+	def accumulate_marginals(self,margAcc,batchMargEsts,batchLogWeights,batchPolarized):
+		'''
+		Adds a batch to margAcc, the running log-sum over polarized samples of
+		each marginal weighted by its log-LR, of shape (s, t_sel, epochs, NG).
+		'''
+		if not np.any(batchPolarized):
+			return margAcc
+		logWeights = np.moveaxis(batchLogWeights,-1,0)[batchPolarized]
+		batchAcc = logsumexp(batchMargEsts[batchPolarized] + logWeights[...,np.newaxis,np.newaxis],axis=0)
+		if margAcc is None:
+			return batchAcc
+		return np.logaddexp(margAcc,batchAcc)
+
+	def score(self,treeSamples,derInds,ancInds,ancHap=None,popFreq=None,discretizedPopFreqIdx=None,
+			ssv=False,selCoeff=None,tSel=None,indsToPrune=[],prior=False,marginals='all',margThreshold=None,
+			checkpoint=None,checkpointInfo={},checkpointEvery=100,essTol=None,seTol=None,minSamples=10,
+			coarseStep=None,continuousS=False,sTol=1e-4,bothBins=False):
+		'''
+		Scores one site from its newick tree samples; either popFreq or its bin
+		discretizedPopFreqIdx must be given. Returns the estimates clues.py
+		writes to its .h5 output as a dict; the options are those of clues.py.
+		With marginals 'best', coarseStep, continuousS or checkpoint, the samples
+		are read more than once, so treeSamples must be re-iterable (a list or
+		clues_utils.read_tree_samples), not an iterator.
+		'''
+		if bothBins:
+			if popFreq == None or checkpoint != None or coarseStep != None or continuousS:
+				raise ValueError('bothBins needs popFreq, and cannot be combined with checkpoint, coarseStep or continuousS')
+			if marginals == 'all':
+				marginals = 'best'
+		if coarseStep != None:
+			if selCoeff != None or prior or checkpoint != None:
+				raise ValueError('coarseStep cannot be combined with selCoeff, prior or checkpoint')
+			if marginals == 'all':
+				marginals = 'best'
+		if continuousS and (ssv or selCoeff != None or self.TRANS_BUILDER == None):
+			raise ValueError('continuousS needs a transBuilder, and cannot be combined with ssv or selCoeff')
+		if (marginals == 'best' or coarseStep != None or continuousS or checkpoint != None) and iter(treeSamples) is treeSamples:
+			raise TypeError('treeSamples is read more than once with marginals best, coarseStep, continuousS or checkpoint: pass a list or clues_utils.read_tree_samples, not an iterator')
+		resume = None
+		if checkpoint != None:
+			settings = checkpoint_settings(self,derInds,ancInds,ancHap,indsToPrune,ssv,selCoeff,tSel,marginals == 'all',checkpointInfo)
+			resume = read_checkpoint(checkpoint,settings)
+			if resume != None:
+				discretizedPopFreqIdx = resume['discretizedPopFreqIdx']
+		binWeights = None
+		if discretizedPopFreqIdx == None:
+			if popFreq == None:
+				raise NotImplementedError('Must enter popFreq')
+			if bothBins:
+				dpfis,binWeights = self.neighbouring_bins(popFreq)
+				discretizedPopFreqIdx = dpfis[np.argmax(binWeights)]
+				if len(dpfis) == 1:
+					binWeights = None
+			else:
+				discretizedPopFreqIdx = self.discretize_pop_freq(popFreq)
+		if binWeights is None:
+			dpfis = [discretizedPopFreqIdx]
+			## the bin of the job: one for all of trans
+			jobBins = discretizedPopFreqIdx
+			if self.debug:
+				print('Randomized popfreq: %f'%(self.FREQS[discretizedPopFreqIdx]))
+		elif self.debug:
+			print('Popfreq bins: %f, %f (weights %.3f, %.3f)'%(self.FREQS[dpfis[0]],self.FREQS[dpfis[1]],binWeights[0],binWeights[1]))
+		if binWeights is not None:
+			SAMPLING_TRANS,S_GRID,I_SEL = self.stacked_sampling_trans(dpfis,ssv=ssv,selCoeff=selCoeff,tSel=tSel)
+			## the bin of every s row of the stacked trans
+			jobBins = [dpfi for dpfi in dpfis for _ in S_GRID]
+		elif coarseStep == None:
+			SAMPLING_TRANS,S_GRID,I_SEL = self.sampling_trans(discretizedPopFreqIdx,ssv=ssv,selCoeff=selCoeff,tSel=tSel)
+		else:
+			## read per pass of the grid search
+			SAMPLING_TRANS = None
+			grid = self.sampling_grid(discretizedPopFreqIdx,ssv=ssv,selCoeff=selCoeff,tSel=tSel)
+			S_GRID,I_SEL = grid[2],grid[3]
+
+		n = len(derInds)
+		m = len(ancInds)
+		if self.statDistn:
+			statDistnTerm = np.concatenate([self.SAMPLING_STAT_DISTN[:len(S_GRID),:len(I_SEL),dpfi] - np.log(self.BIN_SIZES[dpfi-1]) for dpfi in dpfis])
+		else:
+			statDistnTerm = None
+		## s values of the rows of trans
+		runSGrid = list(S_GRID)*len(dpfis)
+
+		job = (SAMPLING_TRANS,n,m,jobBins,derInds,ancInds,ancHap,indsToPrune,statDistnTerm)
+		adaptive = essTol != None or seTol != None
+		onBatch = None
+		if checkpoint != None or adaptive:
+			if resume != None:
+				written = [resume['logImportanceWeights'].shape[-1]]
+			else:
+				written = [0]
+			def onBatch(individualLogLRs,margAcc,idxsSamplesCorrectlyPolarized,numSamples):
+				if checkpoint != None and numSamples - written[0] >= checkpointEvery:
+					write_checkpoint(checkpoint,settings,discretizedPopFreqIdx,individualLogLRs,idxsSamplesCorrectlyPolarized,margAcc)
+					written[0] = numSamples
+				if adaptive and numSamples >= minSamples and len(idxsSamplesCorrectlyPolarized) > 0:
+					logLRs = np.concatenate(individualLogLRs,axis=-1)
+					logLRs[np.where(np.isnan(logLRs))] = -np.inf
+					if binWeights is not None:
+						logLRs = mix_bins(logLRs,binWeights)
+						idxsSamplesCorrectlyPolarized = list(np.nonzero(np.isfinite(logLRs[0,0]))[0])
+					## on the grid points scored in this pass
+					est = self.estimate_lr(logLRs,idxsSamplesCorrectlyPolarized,S_GRID,I_SEL,ssv=ssv,selCoeff=selCoeff)
+					return (essTol == None or est['effectiveSampleSize'] >= essTol) and (seTol == None or est['seLogLR'] <= seTol)
+				return False
+		if coarseStep == None:
+			individualLogLRs,margAcc,idxsSamplesCorrectlyPolarized = self.run_samples(treeSamples,job,runSGrid,I_SEL,
+												margs=(marginals == 'all'),start=resume,onBatch=onBatch)
+			gridEvaluated = np.ones((len(S_GRID),len(I_SEL)),dtype=bool)
+		else:
+			individualLogLRs,idxsSamplesCorrectlyPolarized,gridEvaluated = self.grid_search(treeSamples,job,grid,coarseStep,onBatch=onBatch)
+			margAcc = None
+		numImportanceSamples = individualLogLRs.shape[-1]
+		if binWeights is not None:
+			## the samples' likelihoods under the mixture of the bins
+			binLogLikelihoods = individualLogLRs
+			individualLogLRs = mix_bins(binLogLikelihoods,binWeights)
+			idxsSamplesCorrectlyPolarized = list(np.nonzero(np.isfinite(individualLogLRs[0,0]))[0])
+		if checkpoint != None:
+			write_checkpoint(checkpoint,settings,discretizedPopFreqIdx,[individualLogLRs],idxsSamplesCorrectlyPolarized,margAcc)
+
+		res = self.estimate_lr(individualLogLRs,idxsSamplesCorrectlyPolarized,S_GRID,I_SEL,ssv=ssv,selCoeff=selCoeff)
+		iHat,jHat = res['iHat'],res['jHat']
+		if continuousS:
+			res.update(self.optimize_s(treeSamples,job,res,individualLogLRs,idxsSamplesCorrectlyPolarized,sTol=sTol))
+		iMarg,jMarg = iHat,jHat
+		if marginals == 'best' and (margThreshold == None or res['logLikelihoodRatios'][iHat,jHat] >= margThreshold):
+			margGrid = (runSGrid,I_SEL)
+			polarized = np.zeros(numImportanceSamples,dtype=bool)
+			polarized[idxsSamplesCorrectlyPolarized] = True
+			with np.errstate(invalid='ignore'):
+				if binWeights is None:
+					logWeights = individualLogLRs - individualLogLRs[0,0,:]
+				else:
+					## each bin's share of the mixture, against the mixture null
+					logWeights = np.concatenate([np.log(w) + block for (w,block) in zip(binWeights,np.split(binLogLikelihoods,len(dpfis)))]) - individualLogLRs[0,0,:]
+			if not prior:
+				## the best grid point only (of every bin)
+				rows = [iHat + i_b*len(S_GRID) for i_b in range(len(dpfis))]
+				if coarseStep == None:
+					trans = SAMPLING_TRANS
+					if isinstance(trans,transition_store.EpochSlabTrans):
+						trans = trans.read_all()
+					trans = trans[rows][:,jHat:jHat+1]
+				else:
+					trans = self.TRANS_STORE.read_trans(discretizedPopFreqIdx,[grid[0][iHat]],[grid[1][jHat]])
+				if statDistnTerm is not None:
+					statDistnTerm = statDistnTerm[rows][:,jHat:jHat+1]
+				if binWeights is not None:
+					job = job[:3] + (dpfis,) + job[4:]
+				job = (trans,) + job[1:-1] + (statDistnTerm,)
+				iMarg,jMarg = 0,0
+				margGrid = ([S_GRID[iHat]]*len(dpfis),[I_SEL[jHat]])
+				logWeights = logWeights[rows][:,jHat:jHat+1]
+			## only the samples scored in the first pass (fewer than treeSamples
+			## holds if the first pass stopped early)
+			treeSamples = itertools.islice(treeSamples,numImportanceSamples)
+			margAcc = self.run_samples(treeSamples,job,margGrid[0],margGrid[1],verbose=False,
+							logWeights=logWeights,polarized=polarized)[1]
+			if binWeights is not None:
+				margAcc = logsumexp(np.split(margAcc,len(dpfis)),axis=0)
+
+		res.update(self.estimate_trajectory(margAcc,res['logLikelihoodRatios'],S_GRID,I_SEL,iMarg,jMarg,prior=prior))
+		res['logImportanceWeights'] = individualLogLRs
+		res['discretizedPopFreqIdx'] = discretizedPopFreqIdx
+		if bothBins:
+			res['popFreqBins'] = dpfis
+			res['popFreqBinWeights'] = binWeights if binWeights is not None else [1.]
+		res['numImportanceSamples'] = numImportanceSamples
+		res['numSamplesWronglyPolarized'] = numImportanceSamples - len(idxsSamplesCorrectlyPolarized)
+		res['gridEvaluated'] = gridEvaluated
+		res['transBytesRead'] = self.TRANS_STORE.bytesRead
+		return res
+
+	def grid_search(self,treeSamples,job,grid,coarseStep,onBatch=None):
+		'''
+		Coarse-to-fine search over the s rows of the grid (every t_sel of a row):
+		every coarseStep-th row first, then the rows around the best row and the
+		best hard-sweep row until their neighbours are scored. Returns the log-LRs
+		(-inf where not scored), the polarized samples and the scored mask.
+		'''
+		I_S,I_TRANS_SEL,S_GRID,I_SEL = grid
+		discretizedPopFreqIdx = job[3]
+		statDistnTerm = job[-1]
+		shape = (len(S_GRID),len(I_SEL))
+		gridEvaluated = np.zeros(shape,dtype=bool)
+		rows = coarse_indices(shape[0],coarseStep)
+		individualLogLRs = None
+		while True:
+			trans = self.TRANS_STORE.read_trans(discretizedPopFreqIdx,[I_S[i] for i in rows],I_TRANS_SEL,lazy=self.lazyTrans)
+			if statDistnTerm is not None:
+				subJob = (trans,) + job[1:-1] + (statDistnTerm[rows],)
+			else:
+				subJob = (trans,) + job[1:]
+			subGrid = [S_GRID[i] for i in rows]
+			if individualLogLRs is None:
+				logLRs,_,idxsSamplesCorrectlyPolarized = self.run_samples(treeSamples,subJob,subGrid,I_SEL,
+												margs=False,onBatch=onBatch)
+				individualLogLRs = -np.inf * np.ones(shape+(logLRs.shape[-1],))
+			else:
+				logLRs = self.run_samples(itertools.islice(treeSamples,individualLogLRs.shape[-1]),subJob,subGrid,I_SEL,
+								margs=False,verbose=False)[0]
+			individualLogLRs[rows] = logLRs
+			gridEvaluated[rows] = True
+			if self.debug:
+				print('Grid points scored: %d of %d'%(np.sum(gridEvaluated),gridEvaluated.size))
+
+			if len(idxsSamplesCorrectlyPolarized) == 0:
+				break
+			est = self.estimate_lr(individualLogLRs,idxsSamplesCorrectlyPolarized,S_GRID,I_SEL)
+			logLikelihoodRatios = est['logLikelihoodRatios']
+			## the best row, and the best hard-sweep row
+			peaks = set([est['iHat'],int(np.argmax(logLikelihoodRatios[:,-1]))])
+			rows = set()
+			for iPeak in peaks:
+				if not all(gridEvaluated[max(iPeak-1,0):iPeak+2,0]):
+					rows.update(range(max(iPeak-coarseStep+1,0),min(iPeak+coarseStep,shape[0])))
+			rows = [i for i in sorted(rows) if not gridEvaluated[i,0]]
+			if len(rows) == 0:
+				break
+		return individualLogLRs,idxsSamplesCorrectlyPolarized,gridEvaluated
+
+	def optimize_s(self,treeSamples,job,lrRes,individualLogLRs,idxsSamplesCorrectlyPolarized,sTol=1e-4):
+		'''
+		Refines the hard-sweep sHat between its grid neighbours with a bounded
+		1-D optimizer, rescoring the samples with matrices from TRANS_BUILDER.
+		Returns sHatContinuous, logLRContinuous and sEvaluations.
+		'''
+		discretizedPopFreqIdx = job[3]
+		S_GRID = lrRes['sGrid']
+		iHat = lrRes['iHat']
+		numSamples = individualLogLRs.shape[-1]
+		nullLogLikelihoods = individualLogLRs[0,0,idxsSamplesCorrectlyPolarized]
+		sEvaluations = []
+
+		def neg_log_lr(s):
+			trans,logStatDistn = self.TRANS_BUILDER.conditional_trans(s,discretizedPopFreqIdx,self.AW_TIMES)
+			if self.statDistn:
+				statDistnTerm = logStatDistn - np.log(self.BIN_SIZES[discretizedPopFreqIdx-1])
+			else:
+				statDistnTerm = None
+			sJob = (trans,) + job[1:-1] + (statDistnTerm,)
+			logLikelihoods = self.run_samples(itertools.islice(treeSamples,numSamples),sJob,[s],lrRes['iSel'],
+								margs=False,verbose=False)[0]
+			logLR = -np.log(len(idxsSamplesCorrectlyPolarized)) + logsumexp(logLikelihoods[0,0,idxsSamplesCorrectlyPolarized] - nullLogLikelihoods)
+			if self.debug:
+				print('s: %.6f,\tlogLR: %.3f'%(s,logLR))
+			sEvaluations.append((s,logLR))
+			return -logLR
+
+		bounds = (S_GRID[max(iHat-1,0)],S_GRID[min(iHat+1,len(S_GRID)-1)])
+		opt = minimize_scalar(neg_log_lr,bounds=bounds,method='bounded',options={'xatol':sTol})
+		return {'sHatContinuous':opt.x,
+			'logLRContinuous':-opt.fun,
+			'sEvaluations':np.array(sEvaluations)}
+
+	def estimate_lr(self,individualLogLRs,idxsSamplesCorrectlyPolarized,S_GRID,I_SEL,ssv=False,selCoeff=None):
+		## importance-sampling estimates of the LRs and of sHat/tHat
+		AW_TIMES = self.AW_TIMES
+		logLikelihoodRatios = -np.log(len(idxsSamplesCorrectlyPolarized)) + logsumexp([individualLogLRs[:,:,k] - individualLogLRs[0,0,k] for k in idxsSamplesCorrectlyPolarized],axis=0)
+		logLikelihoodRatios[np.where(np.isnan(logLikelihoodRatios))[0]] = -np.inf
+		if not selCoeff:
+			idx = np.unravel_index(logLikelihoodRatios.argmax(), logLikelihoodRatios.shape)
+			iHat = idx[0]
+			sHat = S_GRID[iHat]
+
+			jHat = idx[1]
+			tHat = AW_TIMES[jHat+1]
+		else:
+			if not ssv:
+				iHat = 1
+				jHat = 0
+				sHat = selCoeff
+				tHat = AW_TIMES[-1]
+			else:
+				raise NotImplementedError
+		effectiveSampleSize,seLogLR = importance_diagnostics(individualLogLRs[iHat,jHat,idxsSamplesCorrectlyPolarized] - individualLogLRs[0,0,idxsSamplesCorrectlyPolarized])
+		return {'logLikelihoodRatios':logLikelihoodRatios,
+			'effectiveSampleSize':effectiveSampleSize,
+			'seLogLR':seLogLR,
+			'sGrid':S_GRID,
+			'iSel':I_SEL,
+			'iHat':iHat,
+			'jHat':jHat,
+			'sHat':sHat,
+			'tHat':tHat}
+
+	def estimate_trajectory(self,margAcc,logLikelihoodRatios,S_GRID,I_SEL,iMarg,jMarg,prior=False):
+		'''
+		Importance-sampling trajectory at the best grid point (iMarg, jMarg), or
+		averaged over the grid posterior with prior; empty without marginals.
+		'''
+		ds = self.ds
+		FREQS = self.FREQS
+		AW_TIMES = self.AW_TIMES
+		#max marginal trajectory
+		xHat = []
+		xHatLo = []
+		xHatHi = []
+		xMargs = []
+		posterior_s = None
+		if prior:
+			if len(I_SEL) == 0:
+				lebesgue_measure = np.concatenate(([1*(np.max(S_GRID) - np.min(S_GRID))],np.diff(S_GRID)))
+				lebesgue_measure = np.log(lebesgue_measure)
+				lebesgue_measure -= logsumexp(lebesgue_measure)
+			else:
+				lebesgue_measure_s = np.concatenate(([1*(np.max(S_GRID) - np.min(S_GRID))],np.diff(S_GRID)))
+				lebesgue_measure_t = np.diff(AW_TIMES[[0] + I_SEL])
+				lebesgue_measure = np.log(np.outer(lebesgue_measure_s,lebesgue_measure_t))
+				lebesgue_measure -= logsumexp(lebesgue_measure)
+			posterior_s = lebesgue_measure + logLikelihoodRatios
+			posterior_s -= logsumexp(posterior_s)
+		if margAcc is None:
+			return {'posterior':posterior_s,'xMargs':xMargs,'xHat':xHat,'xHatLo':xHatLo,'xHatHi':xHatHi}
+		for j in range(len(ds)):
+			if prior:
+				marg = logsumexp(np.moveaxis(margAcc[:,:,j,:],-1,0) + posterior_s,axis=(1,2))
+			else:
+				# importance sampling on trajs
+				marg = margAcc[iMarg,jMarg,j,:]
+			marg = marg - logsumexp(marg)
+
+			xMargs.append(marg)
+			distn = stats.rv_discrete(a=0,b=1,values=(FREQS,np.exp(marg)))
+
+			I = distn.interval(0.95)
+			xHat.append(FREQS[np.argmax(marg)])
+			xHatLo.append(I[0])
+			xHatHi.append(I[1])
+
+		return {'posterior':posterior_s,'xMargs':xMargs,'xHat':xHat,'xHatLo':xHatLo,'xHatHi':xHatHi}
+
+def checkpoint_settings(engine,derInds,ancInds,ancHap,indsToPrune,ssv,selCoeff,tSel,margs,checkpointInfo):
+	## everything a checkpoint's samples depend on, as a JSON string
+	settings = {'derInds':list(derInds),'ancInds':list(ancInds),'ancHap':ancHap,'indsToPrune':list(indsToPrune),
+			'ssv':ssv,'selCoeff':selCoeff,'tSel':tSel,'margs':margs,
+			'statDistn':engine.statDistn,'timeScale':engine.timeScale,
+			'approx':int(engine.GRIFFITHS_TAVARE_CHANGEPOINT),
+			'sGrid':np.array(engine.S_GRID).tolist(),'iSel':np.array(engine.I_SEL).tolist(),
+			'conditionalTrans':os.path.abspath(engine.conditionalTrans),
+			'info':checkpointInfo}
+	return json.dumps(settings,sort_keys=True)
+
+def read_checkpoint(path,settings):
+	## state saved by write_checkpoint, or None if there is no checkpoint yet
+	if not os.path.exists(path):
+		return None
+	f = h5py.File(path,'r')
+	saved = f.attrs['settings']
+	if not isinstance(saved,str):
+		saved = saved.decode()
+	if json.loads(saved) != json.loads(settings):
+		f.close()
+		raise ValueError('checkpoint %s was written with different settings'%(path))
+	state = {'discretizedPopFreqIdx':int(f.attrs['discretizedPopFreqIdx']),
+		'logImportanceWeights':f['logImportanceWeights'][()],
+		'polarized':f['polarized'][()]}
+	if 'margAcc' in f:
+		state['margAcc'] = f['margAcc'][()]
+	else:
+		state['margAcc'] = None
+	f.close()
+	return state
+
+def write_checkpoint(path,settings,discretizedPopFreqIdx,individualLogLRs,idxsSamplesCorrectlyPolarized,margAcc):
+	'''
+	Saves the per-sample log-LRs (a list of (s, t_sel, samples) blocks),
+	polarization flags and marginal accumulator; the file is written next
+	to path and then renamed over it, so a killed run leaves the previous
+	checkpoint intact
+	'''
+	logLRs = np.concatenate(individualLogLRs,axis=-1)
+	polarized = np.zeros(logLRs.shape[-1],dtype=bool)
+	polarized[idxsSamplesCorrectlyPolarized] = True
+	tmpPath = path + '.tmp'
+	f = h5py.File(tmpPath,'w')
+	f.attrs['settings'] = settings
+	f.attrs['discretizedPopFreqIdx'] = discretizedPopFreqIdx
+	f.create_dataset('logImportanceWeights',data=logLRs)
+	f.create_dataset('polarized',data=polarized)
+	if margAcc is not None:
+		f.create_dataset('margAcc',data=margAcc)
+	f.close()
+	os.rename(tmpPath,path)
+	return
+
+def importance_diagnostics(logWeights):
+	'''
+	Effective sample size (sum w)^2 / sum w^2 of the importance weights
+	exp(logWeights), and the Monte Carlo standard error of the log of their
+	mean, sqrt(1/ESS - 1/K) by the delta method
+	'''
+	K = len(logWeights)
+	if K == 0:
+		return np.nan,np.nan
+	with np.errstate(invalid='ignore'):
+		ess = np.exp(2*logsumexp(logWeights) - logsumexp(2*logWeights))
+	se = np.sqrt(max(1/ess - 1/K,0))
+	return ess,se
+
+def mix_bins(logLikelihoods,weights):
+	## log-likelihoods of the mixture of the bins stacked along the s axis
+	## (see CluesEngine.stacked_sampling_trans), with the given weights
+	blocks = np.split(logLikelihoods,len(weights),axis=0)
+	return logsumexp([np.log(w) + block for (w,block) in zip(weights,blocks)],axis=0)
+
+def coarse_indices(size,step):
+	## every step-th index of range(size), and the last one
+	idxs = list(range(0,size,step))
+	if idxs[-1] != size-1:
+		idxs.append(size-1)
+	return idxs
+
+def branch_count_eps(n,m):
+	'''
+	eps of clues_utils.branch_counts_array for the (der, anc, mix) classes,
+	deciding the epoch of coalescences that fall exactly on AW_TIMES.
+	'''
+	if n >= 2 and m >= 2:
+		return np.array([10**-10,10**-10,10**-10])
+	elif n == 1 and m >= 2:
+		return np.array([0,0.001,0.0011])
+	elif n >= 2 and m == 1:
+		return np.array([1,0,1])
+	elif n == 0 and m >= 2:
+		return np.array([0,1,1])
+	elif n >= 2 and m == 0:
+		return np.array([1,0,0])
+	return np.array([10**-10,10**-10,10**-10])
+
+def initial_counts(n,m):
+	## lineage counts (derived, ancestral, mixed) at the present
+	Cder0 = n
+	Canc0 = m
+	if m >= 1 and n >= 1:
+		Cmix0 = m+1
+	elif m == 0 and n >= 2:
+		Cmix0 = 1
+	elif m >= 2 and n == 0:
+		Cmix0 = m
+	return np.array([Cder0,Canc0,Cmix0])
+
+## state of each --workers process: a copy of the engine and of the current job
+WORKER_ENGINE = None
+WORKER_JOB = None
+
+def init_worker(engine,job):
+	global WORKER_ENGINE
+	global WORKER_JOB
+	WORKER_ENGINE = engine
+	WORKER_JOB = job
+	return
+
+def score_batch_in_worker(nwks):
+	return WORKER_ENGINE.score_batch(nwks,*WORKER_JOB)
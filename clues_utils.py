@@ -1,5 +1,8 @@
 from __future__ import division
 import numpy as np
+import gzip
+import io
+import itertools
 from scipy.special import comb, logsumexp
 from scipy import special
 from scipy import stats
@@ -32,6 +35,158 @@ def coal_times(clades):
             else:
                 return [rbl + right_times[0]] + left_times + right_times
 
+def open_trees_file(treesFile):
+	## arg-summarize output, read transparently if gzipped (.gz)
+	if treesFile.endswith('.gz'):
+		return io.TextIOWrapper(gzip.open(treesFile,'rb'))
+	return open(treesFile,'r')
+
+def iter_tree_samples(treesFile,burnin=0,thin=1):
+	'''
+	Generator over the newick strings of the MCMC samples in an arg-summarize
+	trees file. Header lines are skipped and burnin/thin are applied while
+	reading, so only the current line is held in memory.
+	'''
+	with open_trees_file(treesFile) as f:
+		lines = (line for line in f if line[0] != '#' and line[0] != 'R' and line[0] != 'N')
+		for line in itertools.islice(lines,burnin,None,thin):
+			yield line.rstrip().split()[-1]
+
+class read_tree_samples(object):
+	'''
+	Re-iterable iter_tree_samples: every iteration streams the file again.
+	With seed, the samples are instead read in full and yielded in a random
+	order fixed by the seed (the same order on every iteration).
+	'''
+	def __init__(self,treesFile,burnin=0,thin=1,seed=None):
+		self.treesFile = treesFile
+		self.burnin = burnin
+		self.thin = thin
+		self.seed = seed
+
+	def __iter__(self):
+		samples = iter_tree_samples(self.treesFile,burnin=self.burnin,thin=self.thin)
+		if self.seed == None:
+			return samples
+		samples = list(samples)
+		order = np.random.RandomState(self.seed).permutation(len(samples))
+		return (samples[k] for k in order)
+
+	def count(self):
+		## number of samples (after burnin and thin)
+		return sum([1 for _ in iter_tree_samples(self.treesFile,burnin=self.burnin,thin=self.thin)])
+
+def batched(iterable,size=None):
+	## yields lists of up to size items (all remaining items if size is None)
+	it = iter(iterable)
+	while True:
+		batch = list(itertools.islice(it,size))
+		if len(batch) == 0:
+			return
+		yield batch
+
+def parse_newick(nwk):
+	'''
+	Single-pass Newick parser. Returns parallel lists (names, parents,
+	lengths, children) indexed by node, with node 0 the root; nodes are
+	numbered in pre-order, so every parent precedes its children.
+	Bracketed comments (e.g. ARGweaver's [&&NHX:...]) are skipped.
+	'''
+	names = []
+	parents = []
+	lengths = []
+	children = []
+	def new_node(parent):
+		names.append('')
+		parents.append(parent)
+		lengths.append(0.0)
+		children.append([])
+		if parent >= 0:
+			children[parent].append(len(names)-1)
+		return len(names)-1
+
+	cur = new_node(-1)
+	i = 0
+	L = len(nwk)
+	while i < L:
+		c = nwk[i]
+		if c == '(':
+			cur = new_node(cur)
+			i += 1
+		elif c == ',':
+			cur = new_node(parents[cur])
+			i += 1
+		elif c == ')':
+			cur = parents[cur]
+			i += 1
+		elif c == '[':
+			i = nwk.index(']',i) + 1
+		elif c == ':':
+			j = i + 1
+			while j < L and nwk[j] not in ',)[;':
+				j += 1
+			lengths[cur] = float(nwk[i+1:j])
+			i = j
+		elif c == ';' or c.isspace():
+			i += 1
+		else:
+			j = i
+			while j < L and nwk[j] not in '(),:;[':
+				j += 1
+			names[cur] = nwk[i:j].strip()
+			i = j
+	return names,parents,lengths,children
+
+def coal_times_by_class(nwk,removeSets):
+	'''
+	Sorted coalescence times of nwk after pruning each set of leaf names in
+	removeSets, from one parse; matches Bio.Phylo's Tree.prune + coal_times.
+	'''
+	names,parents,lengths,children = parse_newick(nwk)
+	allTimes = []
+	for removeSet in removeSets:
+		removeSet = set(removeSet)
+		rep = [-1]*len(names)	# collapsed node that stands in for each node
+		repLength = [0.0]*len(names)	# branch length above rep, up to the node's parent
+		height = [0.0]*len(names)
+		isLeaf = [False]*len(names)
+		times = []
+		for node in range(len(names)-1,-1,-1):
+			if len(children[node]) == 0:
+				if names[node] not in removeSet:
+					rep[node] = node
+					repLength[node] = lengths[node]
+					isLeaf[node] = True
+				continue
+			kept = [c for c in children[node] if rep[c] >= 0]
+			if len(kept) == 0:
+				continue
+			elif len(kept) == 1:
+				rep[node] = rep[kept[0]]
+				repLength[node] = repLength[kept[0]] + lengths[node]
+				continue
+			[left,right] = kept
+			lbl = repLength[left]
+			rbl = repLength[right]
+			left = rep[left]
+			right = rep[right]
+			## same rules as coal_times
+			if isLeaf[left] and isLeaf[right]:
+				height[node] = rbl
+			elif isLeaf[left]:
+				height[node] = lbl
+			elif isLeaf[right]:
+				height[node] = rbl
+			elif lbl < rbl:
+				height[node] = lbl + height[left]
+			else:
+				height[node] = rbl + height[right]
+			times.append(height[node])
+			rep[node] = node
+			repLength[node] = lengths[node]
+		allTimes.append(np.sort(times))
+	return allTimes
+
 def branch_counts(coalTimes, timePts, eps=1):
 	## return number of lineages at each time point
 	n = len(coalTimes) + 1
@@ -47,6 +202,29 @@ def branch_counts(coalTimes, timePts, eps=1):
 	return C
 
 
+def log_matvec(logA,logx):
+	## log(exp(logA) . exp(logx)); contracts the last axis of logA,
+	## broadcasting over any leading axes
+	return logsumexp(logA + logx[...,np.newaxis,:],axis=-1)
+
+def log_vecmat(logx,logA):
+	## log(exp(logx) . exp(logA)); contracts the second-to-last axis of logA,
+	## broadcasting over any leading axes
+	return logsumexp(logx[...,:,np.newaxis] + logA,axis=-2)
+
+def branch_counts_array(coalTimes, timePts, eps=1):
+	'''
+	Vectorized branch_counts[1:] for coalescence times of shape (...,maxCoal),
+	padded by np.inf; a lineage still counts at tp if it coalesces at or after
+	tp + eps. Returns int32 counts of shape (...,len(timePts)).
+	'''
+	coalTimes = np.asarray(coalTimes,dtype=float)
+	n = np.sum(np.isfinite(coalTimes),axis=-1) + 1
+	edges = np.asarray(timePts,dtype=float) + np.asarray(eps,dtype=float)[...,np.newaxis]
+	## number of coalescences before each edge, i.e. np.searchsorted(row,edges,side='left') on every row
+	j = np.sum(coalTimes[...,np.newaxis,:] < edges[...,:,np.newaxis],axis=-1)
+	return (n[...,np.newaxis] - j).astype(np.int32)
+
 def log_falling_factorial(a,k):
 	if k >= 1:
 		return np.sum(np.log(np.arange(a-k+1,a+1)))
@@ -77,6 +255,58 @@ def griffiths_log_prob_coal_counts(a,b,t,N):
     return stats.norm.logpdf(b,mu,std) - logsumexp(stats.norm.logpdf(np.arange(1,a+1),mu,std))
 
 
+def griffiths_moments(a,t):
+    ## mean and std of Griffiths' normal approximation, with t in units of 2N
+    n = a
+    alpha = 1/2*n*t
+    beta = -1/2*t
+    h = eta(alpha,beta)
+    mu = 2 * h * t**(-1)
+    var = 2*h*t**(-1) * (h + beta)**2
+    var *= (1 + h/(h+beta) - h/alpha - h/(alpha + beta) - 2*h)
+    var *= beta**-2
+    std = np.sqrt(var)
+    return mu,std
+
+def norm_logpdf(x,mu,std):
+    ## closed-form stats.norm.logpdf, without the distribution-object overhead
+    return -0.5*((x-mu)/std)**2 - np.log(std) - 0.5*np.log(2*np.pi)
+
+GRIFFITHS_LOG_NORMALIZER_DICT = {}
+
+def griffiths_log_normalizer(a,t):
+    '''
+    log of sum_{j=1..a} N(j; mu, std) for arrays of a and scaled t (units
+    of 2N). Each distinct (a, t) pair is computed once, in a single
+    vectorized pass, and cached for later calls.
+    '''
+    a,t = np.broadcast_arrays(np.asarray(a,dtype=int),np.asarray(t,dtype=float))
+    keys = list(zip(a.ravel().tolist(),t.ravel().tolist()))
+    missing = list(set([key for key in keys if key not in GRIFFITHS_LOG_NORMALIZER_DICT]))
+    if len(missing) > 0:
+        ma = np.array([key[0] for key in missing])
+        mt = np.array([key[1] for key in missing])
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            mu,std = griffiths_moments(ma,mt)
+            j = np.arange(1,np.max(ma)+1)
+            logpdf = norm_logpdf(j[np.newaxis,:],mu[:,np.newaxis],std[:,np.newaxis])
+            logpdf[j[np.newaxis,:] > ma[:,np.newaxis]] = -np.inf
+            Z = logsumexp(logpdf,axis=1)
+        GRIFFITHS_LOG_NORMALIZER_DICT.update(zip(missing,Z.tolist()))
+    return np.array([GRIFFITHS_LOG_NORMALIZER_DICT[key] for key in keys]).reshape(a.shape)
+
+def griffiths_log_prob_coal_counts_array(a,b,t,N):
+    '''
+    Array version of griffiths_log_prob_coal_counts: a, b, t and N are
+    broadcast against each other, using a closed-form normal log-density
+    and the cached normalizers of griffiths_log_normalizer.
+    '''
+    a,b,t,N = np.broadcast_arrays(*[np.asarray(x,dtype=float) for x in (a,b,t,N)])
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        t = t/(2*N)
+        mu,std = griffiths_moments(a,t)
+        return norm_logpdf(b,mu,std) - griffiths_log_normalizer(a,t)
+
 def tavare_log_prob_coal_counts(a, b, t, n):
 
     lnC1 = 0.0
@@ -107,6 +337,60 @@ def tavare_log_prob_coal_counts(a, b, t, n):
 
     return s + lnC1
 
+def tavare_log_prob_coal_counts_array(a, b, t, n, tol=1e-14):
+    '''
+    Array version of tavare_log_prob_coal_counts, broadcasting a, b, t and n;
+    the series stops elementwise once its terms fall below tol.
+    '''
+    a, b, t, n = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in (a, b, t, n)])
+    out = -np.inf * np.ones(a.shape)
+    valid = (b >= 1) & (b <= a)
+    a, b, t, n = a[valid], b[valid], t[valid], n[valid]
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        lnC1 = special.gammaln(2*b) - special.gammaln(b) \
+                + special.gammaln(a+1) - special.gammaln(a-b+1) \
+                - special.gammaln(a+b) + special.gammaln(a)
+        s = -b*(b-1)*t/4.0/n
+        lnC2 = np.zeros(a.shape)
+        prev = s.copy()
+        C3 = 1.0
+        active = np.nonzero(a > b)[0]
+        j = 1
+        while len(active) > 0:
+            ka, kb, kt, kn = a[active], b[active], t[active], n[active]
+            k = kb + j
+            k1 = k - 1
+            lnC2[active] += np.log((kb+k1)*(ka-k1)/(ka+k1)/(k-kb))
+            C3 *= -1.0
+            val = -k*k1*kt/4.0/kn + lnC2[active] + np.log((2.0*k-1)/(k1+kb))
+            loga = np.maximum(s[active], val)
+            logc = np.minimum(s[active], val)
+            s[active] = loga + np.log1p(C3*np.exp(logc - loga))
+            ## the terms are log-concave in k, so once they start to decrease
+            ## the remainder of the alternating series is bounded by the last term
+            done = (k >= ka) | ((val < prev[active]) & (val - s[active] < np.log(tol)))
+            prev[active] = val
+            active = active[~done]
+            j += 1
+        s -= special.gammaln(b+1)
+
+    out[valid] = s + lnC1
+    return out
+
+def log_coal_count_rows(a,b,t,N,isTavare):
+        ## log-probs of a[i] -> b[i] lineages in time t, for each population size
+        ## in N; returns shape (len(a),) + np.shape(N), with non-finite values
+        ## mapped to -inf
+        a = np.asarray(a)[(slice(None),) + (np.newaxis,)*np.ndim(N)]
+        b = np.asarray(b)[(slice(None),) + (np.newaxis,)*np.ndim(N)]
+        if isTavare:
+                rows = tavare_log_prob_coal_counts_array(a,b,t,N)
+        else:
+                rows = griffiths_log_prob_coal_counts_array(a,b,t,N)
+        rows[np.isnan(rows) | np.isinf(rows)] = -np.inf
+        return rows
+
 def tavare_structured_coal(Cder0,Cder1,Canc0,Canc1,Cmix0,Cmix1,Nnow,x,t,isTavare):
         '''
         Cder0: number of of lineages at start of the epoch (backwards in time)
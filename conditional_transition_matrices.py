@@ -3,17 +3,16 @@ import numpy as np
 import gzip
 import sys
 import pickle
-from scipy.misc import logsumexp
 from scipy.optimize import minimize
 import scipy.stats as stats
 import scipy.optimize as opt
 import clues_utils as clues
 import glob
 import h5py
-from Bio import Phylo
-from io import StringIO
 import warnings
 import argparse
+import multiprocessing
+from transition_store import condition_trans_mats,parse_log_file
 warnings.filterwarnings("ignore")
 parser = argparse.ArgumentParser(description=
                 'CLUES calculates an estimate of the log-likelihood ratio of '+
@@ -30,19 +29,17 @@ parser.add_argument('--popsize',
             nargs = 2, metavar = ('popsize_file', 'popsize_transMatDir'),default=(None,None))
 parser.add_argument('--debug',action='store_true')
 parser.add_argument('--noSkip',action='store_true',help='check .log file; if 2x popsize lines, DONT use this option.')
-args = parser.parse_args()
-logFile = args.logFile
-transMatDir = args.transMatsDir
-outFile = args.outFile
-popsizeFile = args.popsize[0]
-popsizeTransMatDir = args.popsize[1]
+parser.add_argument('--workers',type=int,default=1,help='number of processes conditioning the s files in parallel; this process alone writes the output')
 
-def clean_trans_mat(mat):
-	for (i,row) in enumerate(mat):
-		row[row<=0] = 0
-		row = row/np.sum(row)
-		mat[i,:] = row
-	return mat
+def condition_trans_file(job):
+	## condition_trans_mats on one trans_dir/ file, given by path (for a process pool)
+	h5,h5_neu,discretizedPopFreqIdxs,I_SEL,AW_TIMES,ssv,debug = job
+	mats = h5py.File(h5,'r')
+	neuMats = h5py.File(h5_neu,'r')
+	res = condition_trans_mats(mats,neuMats,mats.attrs['s'],discretizedPopFreqIdxs,I_SEL,AW_TIMES,ssv=ssv,debug=debug)
+	mats.close()
+	neuMats.close()
+	return res
 
 def load_transition_probabilities(transMatDir,popsize,name=None):
         ## Load transition probabilities and create S_GRID and FREQS
@@ -59,13 +56,6 @@ def load_transition_probabilities(transMatDir,popsize,name=None):
         if args.debug:
                 print('Loading transition mats...')
 
-        def logdotexp(A, B):
-                max_A = np.max(A)
-                max_B = np.max(B)
-                C = np.dot(np.exp(A - max_A), np.exp(B - max_B))
-                np.log(C, out=C)
-                C += max_A + max_B
-                return C
         smin = 999
 
         for h5 in glob.glob(transMatDir+'*'):
@@ -93,77 +83,45 @@ def load_transition_probabilities(transMatDir,popsize,name=None):
         else:
                 I_SEL = [len(np.diff(AW_TIMES)) - 1]
         		
-        logStatDistn = np.zeros((len(glob.glob(transMatDir+'*')),len(I_SEL),len(FREQS)))
-        freqsDone = set([])
-        for (i_d,discretizedPopFreqIdx) in enumerate(freqIdxs):
-                discretizedPopFreqIdx = int(discretizedPopFreqIdx)
-                if discretizedPopFreqIdx in freqsDone:
-                        continue
-                if args.debug: 
+        transMatFiles = glob.glob(transMatDir+'*')
+        ## distinct conditioned bins, in order
+        dpfis = []
+        for discretizedPopFreqIdx in freqIdxs:
+                if int(discretizedPopFreqIdx) not in dpfis:
+                        dpfis.append(int(discretizedPopFreqIdx))
+        if args.debug:
+                for discretizedPopFreqIdx in dpfis:
                         print('Conditioning on X(0) = %.3f'%(FREQS[discretizedPopFreqIdx]))
-                S_GRID = []
-                # create group; first level in hierarchy is conditioned frequency
-                data = np.zeros((len(glob.glob(transMatDir+'*')),len(I_SEL),len(AW_TIMES) - 1, len(FREQS),len(FREQS)))
-                for i_s,h5 in enumerate(glob.glob(transMatDir+'*')):
-                        mats = h5py.File(h5,'r')
-                        FREQS = mats.attrs['frequencies']
-                        #import pdb; pdb.set_trace()
-                        s = mats.attrs['s']
-                        S_GRID.append(s)
-                        for ii_sel,i_sel in enumerate(I_SEL):
-                                if args.debug:
-                                        print('Computing s = %.4f,\t SSV @ %d'%(s,AW_TIMES[i_sel]))
-                                stat_distn_mat = np.log(np.eye(len(FREQS)))
-                                stat_distn_mat[np.isnan(stat_distn_mat)] = -np.inf
-                                for (i_dt,dt) in enumerate(np.diff(AW_TIMES)):
-                                        #if args.debug:
-                                        #       print('loading time %d, SSV @ %d, sel coeff %.4f'%(k,ii,s))
-                                        N = popsize[i_dt]
-                                        if i_dt > i_sel:
-                                                if not args.ssv:
-                                                        print("WRONG")
-                                                mat = np.log(clean_trans_mat(np.array(neu_mats['P'+str(i_dt)])))
-                                        else:
-                                                mat = np.log(clean_trans_mat(np.array(mats['P'+str(i_dt)])))
-                                        stat_distn_mat = logdotexp(mat,stat_distn_mat)
-                                        if i_dt == 0:
-                                                timeRemainingTrans = mat
-                                        else:
-                                                nextTimeRemainingTrans = logdotexp(mat,timeRemainingTrans)
-                                        for (i_f0,f0) in enumerate(FREQS):
-                                                for (i_f1,f1) in enumerate(FREQS):
-                                                        if i_dt == 0:
-                                                                if i_f1 == discretizedPopFreqIdx:
-                                                                        data[i_s,ii_sel,i_dt,i_f0,i_f1] = 0
-                                                                        #LOG_TRANS_PROB_DICT[(s,k,f0,f1,i_sel,discretizedPopFreqIdx)] = 0
-                                                                else:
-                                                                        data[i_s,ii_sel,i_dt,i_f0,i_f1] = -np.inf
-                                                                        #LOG_TRANS_PROB_DICT[(s,k,f0,f1,i_sel,discretizedPopFreqIdx)] = -np.inf
-                                                        else:
-                                                                #CONDITIONAL ON PRESENT FREQ:
-                                                                #print(mat[i,j], timeRemainingTrans[j,discretizedPopFreqIdx], nextTimeRemainingTrans[i,discretizedPopFreqIdx])
-                                                                if False:
-                                                                        data[i_s,ii_sel,i_dt,i_f0,i_f1] = mat[i_f0,i_f1]
-                                                                        #LOG_TRANS_PROB_DICT[(s,k,f0,f1,i_sel,discretizedPopFreqIdx)] = mat[i,j]
-                                                                else:
-                                                                        data[i_s,ii_sel,i_dt,i_f0,i_f1] = mat[i_f0,i_f1] + timeRemainingTrans[i_f1,discretizedPopFreqIdx] - nextTimeRemainingTrans[i_f0,discretizedPopFreqIdx]
-                                                                        #LOG_TRANS_PROB_DICT[(s,k,f0,f1,i_sel,discretizedPopFreqIdx)] = mat[i,j] + timeRemainingTrans[j,discretizedPopFreqIdx] - nextTimeRemainingTrans[i,discretizedPopFreqIdx]
-                                                                #if np.isinf(LOG_TRANS_PROB_DICT[(s,dt,f0,f1)]):
-                                                                #       import pdb; pdb.set_trace()
-                                                                if np.isinf(data[i_s,ii_sel,i_dt,i_f0,i_f1]) or np.isnan(data[i_s,ii_sel,i_dt,i_f0,i_f1]):
-                                                                        data[i_s,ii_sel,i_dt,i_f0,i_f1] = -np.inf
-                                        if i_dt > 0:
-                                                timeRemainingTrans = nextTimeRemainingTrans
-                                        print(data[i_s,ii_sel,i_dt,:,:])		        
-                                vec = -np.inf*np.ones(len(FREQS))
-                                vec[0] = 0
-                                stat_distn_vec = logdotexp(vec,stat_distn_mat)
-                                logStatDistn[i_s,ii_sel,:] = stat_distn_vec
-                I_s_sorted = np.argsort(S_GRID)
-                data = data[I_s_sorted,:,:,:,:]
-                S_GRID = np.sort(S_GRID)
-                dset = f.create_dataset("trans_dpfi%d"%(discretizedPopFreqIdx), data=data, compression="gzip")
-                freqsDone =  freqsDone | set([discretizedPopFreqIdx])
+        # one dataset per conditioned frequency, filled one s (in sorted order) at a time
+        S_GRID = []
+        for h5 in transMatFiles:
+                mats = h5py.File(h5,'r')
+                S_GRID.append(mats.attrs['s'])
+                mats.close()
+        I_s_sorted = np.argsort(S_GRID)
+        dsets = [f.create_dataset("trans_dpfi%d"%(discretizedPopFreqIdx),
+                        shape=(len(transMatFiles),len(I_SEL),len(AW_TIMES) - 1, len(FREQS),len(FREQS)),
+                        dtype=np.float64, compression="gzip") for discretizedPopFreqIdx in dpfis]
+        logStatDistn = np.zeros((len(transMatFiles),len(I_SEL),len(FREQS)))
+        ## each s file is read, and its matrix products computed, once for all
+        ## bins; with --workers, in a pool, results still written here in order
+        jobs = [(transMatFiles[i_s],h5_neu,dpfis,I_SEL,AW_TIMES,args.ssv,args.debug) for i_s in I_s_sorted]
+        pool = None
+        if args.workers > 1:
+                pool = multiprocessing.Pool(args.workers)
+                results = pool.imap(condition_trans_file,jobs)
+        else:
+                results = (condition_trans_file(job) for job in jobs)
+        try:
+                for (rank,(data,statDistnRows)) in enumerate(results):
+                        logStatDistn[rank] = statDistnRows
+                        for (i_d,dset) in enumerate(dsets):
+                                dset[rank] = data[i_d]
+        finally:
+                if pool != None:
+                        pool.terminate()
+                        pool.join()
+        S_GRID = np.sort(S_GRID)
         f.attrs['sGrid'] = S_GRID
         f.attrs['iSel'] = I_SEL
         f.attrs['t'] = AW_TIMES
@@ -172,39 +130,6 @@ def load_transition_probabilities(transMatDir,popsize,name=None):
         statDistn = f.create_dataset("stat_distn", data=logStatDistn, compression="gzip")
         return 
 
-def parse_log_file(logFile):
-	## this step is crucial because it parameterizes the discrete-time model.
-	## It sets two global variables:
-	#		AW_TIMES (time discretization used by argweaver and clues)
-	#		SAMPLING_POPSIZE (popsize used by argweaver)
-	global AW_TIMES
-	global SAMPLING_POPSIZE
-	if logFile == '':
-		## if no log file, we hard-code a default discretization (note this may be simply wrong
-		AW_TIMES = np.array([0.000000,62.378528,163.667865,328.140000,595.207431,1028.867597,1733.038592,2876.461093,4733.133724,7747.971422,12643.420512,20592.578708,33500.304814,54459.680528,88493.206395,143756.344893,233491.815987,379202.953491,615806.554427,1000000.000000])
-		SAMPLING_POPSIZE = np.array([10**4 for _ in AW_TIMES])
-	else:	
-		parsingPopsize = False
-		for line in open(logFile,'r'):
-			if len(line.split()) == 0:
-				continue
-			if line.split()[0] == 'times':
-				AW_TIMES = np.array([float(x) for x in line.split()[2][1:][:-1].split(',')])
-			if line.split()[0] == 'popsizes':
-				parsingPopsize = True
-				SAMPLING_POPSIZE = []
-				if line.rstrip()[-1] == ']':
-					SAMPLING_POPSIZE = np.array([float(x) for x in line.split()[2][1:][:-1].split(',')])
-					break
-				else:
-					SAMPLING_POPSIZE = [float(line.split('[')[1].split(',')[0])]
-					continue
-			if parsingPopsize:
-				SAMPLING_POPSIZE.append(float(line.rstrip()[:-1]))
-				if line.rstrip()[-1] == ']':
-					break
-		SAMPLING_POPSIZE = SAMPLING_POPSIZE[::(2-int(args.noSkip))]
-	return	
 def parse_other_popsize(args):
 	if popsizeFile == None:
 		popsize = SAMPLING_POPSIZE
@@ -230,18 +155,26 @@ def parse_other_popsize(args):
 		raise ValueError('You cannot use both the --N and --popsize options. Please try again.')
 	return popsize,reweightDemog
 
- ## load the arg-sample log to obtain time discretization and sampling popsize
-parse_log_file(logFile)
-ds = np.diff(AW_TIMES)
- ## parse extra popsize file (if provided, 
-## i.e. want to calculate likelihood for diff. demog. model than under sampling)
-popsize, reweightDemog = parse_other_popsize(args)
- #load frequency discretization
-a = h5py.File(glob.glob(args.transMatsDir+'*.h5')[0],'r')
-FREQS = a.attrs['frequencies']
- # load transition probabilities
-load_transition_probabilities(transMatDir,SAMPLING_POPSIZE)
-if reweightDemog:
-	load_transition_probabilities(popsizeTransMatDir,popsize,name='reweight')
-#for (i,s) in enumerate(S_GRID):
-#	print(LOG_STAT_DISTN[(s,1)])
+if __name__ == '__main__':
+	args = parser.parse_args()
+	logFile = args.logFile
+	transMatDir = args.transMatsDir
+	outFile = args.outFile
+	popsizeFile = args.popsize[0]
+	popsizeTransMatDir = args.popsize[1]
+
+	## load the arg-sample log to obtain time discretization and sampling popsize
+	AW_TIMES,SAMPLING_POPSIZE = parse_log_file(logFile,noSkip=args.noSkip)
+	ds = np.diff(AW_TIMES)
+	## parse extra popsize file (if provided, 
+	## i.e. want to calculate likelihood for diff. demog. model than under sampling)
+	popsize, reweightDemog = parse_other_popsize(args)
+	#load frequency discretization
+	a = h5py.File(glob.glob(args.transMatsDir+'*.h5')[0],'r')
+	FREQS = a.attrs['frequencies']
+	# load transition probabilities
+	load_transition_probabilities(transMatDir,SAMPLING_POPSIZE)
+	if reweightDemog:
+		load_transition_probabilities(popsizeTransMatDir,popsize,name='reweight')
+	#for (i,s) in enumerate(S_GRID):
+	#	print(LOG_STAT_DISTN[(s,1)])
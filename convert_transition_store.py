@@ -0,0 +1,11 @@
+import transition_store
+import argparse
+
+parser = argparse.ArgumentParser(description=
+                'Converts a conditional transition .hdf5 file (from conditional_transition_matrices.py) '+
+                'into an uncompressed, memory-mappable store directory that clues.py accepts in its place.')
+parser.add_argument('conditionalTrans',type=str,help='the .hdf5 file to convert')
+parser.add_argument('outDir',type=str,help='directory to write header.json and the .npy files to')
+args = parser.parse_args()
+
+transition_store.hdf5_to_npy_store(args.conditionalTrans,args.outDir)
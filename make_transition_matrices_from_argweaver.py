@@ -1,7 +1,7 @@
 from __future__ import division, print_function
 import numpy as np
 import numpy.linalg as npl
-from scipy.misc import comb
+from scipy.special import comb
 import argparse
 import h5py
 import util as ut
@@ -95,7 +95,7 @@ def get_breaks(N, uniform_weight, min_bin_size):
             breaks.append(i+1)
             cur_prob = 0.0
     breaks.append(N)
-    breaks = np.array(breaks, dtype = np.int)
+    breaks = np.array(breaks, dtype = int)
     return breaks
 
 def get_breaks_symmetric(N, uniform_weight, min_bin_size):
@@ -156,7 +156,7 @@ def get_breaks_symmetric(N, uniform_weight, min_bin_size):
     lesser_breaks = [el for el in breaks[::-1] if el < N/2]
     for br in lesser_breaks[:-1]:
         breaks.append(N-br+1)
-    breaks = np.array(breaks, dtype = np.int)
+    breaks = np.array(breaks, dtype = int)
     return breaks
 
 def bin_matrix(P, breaks, log_space):
@@ -165,7 +165,7 @@ def bin_matrix(P, breaks, log_space):
     bin_lengths = np.concatenate((np.diff(breaks), [P.shape[1]-breaks[-1]]))
     break_is_even = (bin_lengths % 2 == 0)
     break_is_odd = np.logical_not(break_is_even)
-    middles = ((bin_lengths-1)/2).astype(np.int)
+    middles = ((bin_lengths-1)/2).astype(int)
 
     if log_space:
         P_binned = np.zeros((breaks.shape[0], breaks.shape[0]))*(-np.inf)
@@ -176,8 +176,8 @@ def bin_matrix(P, breaks, log_space):
 
     P_binned[break_is_odd,:] = P_colsummed[(breaks+middles)[break_is_odd],:]
 
-    left_middles = np.floor((bin_lengths-1)/2).astype(np.int)
-    right_middles = np.ceil((bin_lengths-1)/2).astype(np.int)
+    left_middles = np.floor((bin_lengths-1)/2).astype(int)
+    right_middles = np.ceil((bin_lengths-1)/2).astype(int)
 
     if log_space:
         P_binned[break_is_even,:] = (
@@ -242,7 +242,7 @@ def add_matrix(h5file, P, N, s, u, v, gen, idx, log_space, breaks=None):
     dset.attrs['idx'] = idx
     return
 
-def parse_argweaver_log(fn):
+def parse_argweaver_log(fn, pdebug=print):
     '''
     read model from lines that look like this
 
@@ -272,7 +272,7 @@ def parse_argweaver_log(fn):
                 if line.startswith(key + ' = '):
                     whole_line = []
                     while True:
-                        print(line)
+                        pdebug(line)
                         whole_line.append(line)
                         if ']' in line:
                             break
@@ -294,25 +294,17 @@ def parse_argweaver_log(fn):
             raise ValueError('could not find the following in the argweaver log: {}'.format(', '.join(missings)))
         return values
 
-def _run_make_transition_matrices(args):
-
-    pdebug = get_debug_print(args.debug)
-
-    uniform_weight, min_bin_size = args.breaks
-
-    # parse the argweaver log
-    parsed = parse_argweaver_log(args.argweaverlog)
-
-    N = args.N
-    s = args.s
-
-    breaks = get_breaks(N, uniform_weight, min_bin_size)
-
+def epoch_parameters(N, s, parsed, noSkip=False):
+    '''
+    (generation times, per-generation selection coefficients, mutation
+    probabilities) of the matrices for haploid size N, one per argweaver
+    epoch, from most recent to most ancient
+    '''
     N_aw = parsed['popsizes']   # argweaver population sizes
     times_aw = parsed['times']  # argweaver generation times
     mu = parsed['mu']           # argweaver mutation rate
 
-    N_aw_rev = N_aw[:-1][::-(2-int(args.noSkip))]  # discarding last (reverse, first) pop size, since it corresponds to infinite past, which we're not modeling
+    N_aw_rev = N_aw[:-1][::-(2-int(noSkip))]  # discarding last (reverse, first) pop size, since it corresponds to infinite past, which we're not modeling
     times_aw_rev = np.max(times_aw) - times_aw[::-1]
     ints_aw_rev = np.diff(times_aw_rev)
     # these are the drift times
@@ -327,6 +319,59 @@ def _run_make_transition_matrices(args):
     sel_coeffs = (alphas / (N))   # alpha = 2Ns, where N is haploid, as in our calculations (above, 2N is haploid size)
     mut_rates = (thetas / (2.0*N))
 
+    # going from most recent to most ancient
+    return gen_times[::-1], sel_coeffs[::-1], mut_rates[::-1]
+
+def iter_transition_matrices(N, s, parsed, noSkip=False, log_space=False,
+        pdebug=get_debug_print(False)):
+    '''
+    generator over the (unbinned) transition matrices for selection
+    coefficient s, from most recent to most ancient argweaver epoch
+
+    params
+
+    N          haploid population size for matrices
+    s          selection coefficient
+    parsed     argweaver model, as returned by parse_argweaver_log()
+    noSkip     see --noSkip
+    log_space  yield log transition matrices
+
+    yields
+
+    (P, gen_time, mat_s, mat_uv): P is the transition matrix over gen_time
+    generations, for per-generation selection coefficient mat_s and mutation
+    probability mat_uv
+    '''
+    gen_times, sel_coeffs, mut_rates = epoch_parameters(N, s, parsed, noSkip)
+
+    dataset_idx = 0
+    for gen_time, mat_s, mat_uv in zip(gen_times, sel_coeffs, mut_rates):
+        gen_time = int(np.max([1,int(gen_time+0.5)]))  # before here, gen time is a float
+        pdebug('generating single-gen transition matrix for on g = {}, s = {}, uv = {}, {} of {}'.format(gen_time, mat_s, mat_uv, dataset_idx, len(gen_times)))
+        if log_space:
+            lP = get_log_wright_fisher_transition_matrix(N, mat_s, 0, mat_uv)
+            pdebug('working on matrix multiplication for g = {}, s = {}, uv = {}, {} of {}'.format(gen_time, mat_s, mat_uv, dataset_idx, len(gen_times)))
+            yield log_matrix_power(lP, gen_time), gen_time, mat_s, mat_uv
+        else:
+            P = get_wright_fisher_transition_matrix(N, mat_s, 0, mat_uv)
+            pdebug('working on matrix multiplication for g = {}, s = {}, uv = {}, {} of {}'.format(gen_time, mat_s, mat_uv, dataset_idx, len(gen_times)))
+            yield npl.matrix_power(P, gen_time), gen_time, mat_s, mat_uv
+        dataset_idx += 1
+
+def _run_make_transition_matrices(args):
+
+    pdebug = get_debug_print(args.debug)
+
+    uniform_weight, min_bin_size = args.breaks
+
+    # parse the argweaver log
+    parsed = parse_argweaver_log(args.argweaverlog)
+
+    N = args.N
+    s = args.s
+
+    breaks = get_breaks(N, uniform_weight, min_bin_size)
+
     # now ready to calculate matrices
     with h5py.File(args.output, 'w') as h5file:
         # first write attributes
@@ -350,28 +395,14 @@ def _run_make_transition_matrices(args):
         h5file.attrs['frequencies'] = frequencies
 
         dataset_idx = 0
-        # going to store transition matrices from most recent to most ancient  (notice [::-1])
-        for gen_time, mat_s, mat_uv in zip(gen_times[::-1], sel_coeffs[::-1], mut_rates[::-1]):
-            gen_time = int(np.max([1,int(gen_time+0.5)]))  # before here, gen time is a float
-            pdebug('generating single-gen transition matrix for on g = {}, s = {}, uv = {}, {} of {}'.format(gen_time, mat_s, mat_uv, dataset_idx, len(gen_times)))
-            if args.log_space:
-                lP = get_log_wright_fisher_transition_matrix(N, mat_s, 0, mat_uv)
-                pdebug('working on matrix multiplication for g = {}, s = {}, uv = {}, {} of {}'.format(gen_time, mat_s, mat_uv, dataset_idx, len(gen_times)))
-                lPt = log_matrix_power(lP, gen_time)
-                # the attributes for each individual matrix will reflect the 
-                # terms used to calculate the transitions, which do not reflect the 
-                # input except after being translated through the input population sizes
-                add_matrix(h5file, lPt, args.N, mat_s, 0, mat_uv,
-                        gen_time, dataset_idx, args.log_space, breaks)  # this function does the binning
-            else:
-                P = get_wright_fisher_transition_matrix(N, mat_s, 0, mat_uv)
-                pdebug('working on matrix multiplication for g = {}, s = {}, uv = {}, {} of {}'.format(gen_time, mat_s, mat_uv, dataset_idx, len(gen_times)))
-                Pt = npl.matrix_power(P, gen_time)
-                # the attributes for each individual matrix will reflect the 
-                # terms used to calculate the transitions, which do not reflect the 
-                # input except after being translated through the input population sizes
-                add_matrix(h5file, Pt, args.N, mat_s, 0, mat_uv,
-                        gen_time, dataset_idx, args.log_space, breaks)  # this function does the binning
+        # going to store transition matrices from most recent to most ancient
+        for Pt, gen_time, mat_s, mat_uv in iter_transition_matrices(N, s,
+                parsed, args.noSkip, args.log_space, pdebug):
+            # the attributes for each individual matrix will reflect the 
+            # terms used to calculate the transitions, which do not reflect the 
+            # input except after being translated through the input population sizes
+            add_matrix(h5file, Pt, args.N, mat_s, 0, mat_uv,
+                    gen_time, dataset_idx, args.log_space, breaks)  # this function does the binning
             dataset_idx += 1
 
 
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+
+import clues_utils
+
+LOG_FILE = os.path.join(ROOT,'example','example.log')
+TRANS_DIR = os.path.join(ROOT,'trans_dir')
+POSN = 50000
+POP_FREQ = 0.76375
+BIN = 33
+
+@pytest.fixture(scope='session')
+def conditional_trans(tmp_path_factory):
+	## conditional file for the example site, made the way users make it
+	out = str(tmp_path_factory.mktemp('cond').joinpath('cond'))
+	subprocess.check_call([sys.executable,os.path.join(ROOT,'conditional_transition_matrices.py'),
+		LOG_FILE,TRANS_DIR+'/','-l',str(POP_FREQ),'-o',out],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+	return out + '.hdf5'
+
+@pytest.fixture(scope='session')
+def carriers():
+	## (derInds, ancInds, ancHap) of the example site
+	return clues_utils.derived_carriers_from_sites(os.path.join(ROOT,'example','example.sites'),POSN)
+
+@pytest.fixture(scope='session')
+def trees():
+	return list(clues_utils.read_tree_samples(os.path.join(ROOT,'example','example.trees'),thin=50))
+
+## a small N = 200 trans_dir/ and its conditional file, for matrices built on the fly
+SMALL_S = ['0.0001','0.005','0.02','0.05']
+SMALL_POP_FREQ = 0.7375
+SMALL_BIN = 29
+
+@pytest.fixture(scope='session')
+def small_trans_dir(tmp_path_factory):
+	out = tmp_path_factory.mktemp('small_trans_dir')
+	for s in SMALL_S:
+		subprocess.check_call([sys.executable,os.path.join(ROOT,'make_transition_matrices_from_argweaver.py'),'200',s,LOG_FILE,
+			str(out.joinpath('const.N_200.s_%s.h5'%(s.replace('.','p')))),'--breaks','0.95','0.025'],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+	return str(out)
+
+@pytest.fixture(scope='session')
+def small_conditional_trans(small_trans_dir,tmp_path_factory):
+	out = str(tmp_path_factory.mktemp('small_cond').joinpath('cond'))
+	subprocess.check_call([sys.executable,os.path.join(ROOT,'conditional_transition_matrices.py'),
+		LOG_FILE,small_trans_dir+'/','-l',str(SMALL_POP_FREQ),'-o',out],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+	return out + '.hdf5'
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from clues_engine import CluesEngine
+from conftest import ROOT,POSN,POP_FREQ,BIN
+
+TREES_FILE = os.path.join(ROOT,'example','example.trees')
+SITES_FILE = os.path.join(ROOT,'example','example.sites')
+
+def run_batch(conditionalTrans,popFreqs,tmp_path,options=[]):
+	manifest = str(tmp_path.joinpath('manifest.txt'))
+	out = str(tmp_path.joinpath('table.txt'))
+	f = open(manifest,'w')
+	f.write('# treesFile posn popFreq\n')
+	for popFreq in popFreqs:
+		f.write('%s\t%d\t%s\n'%(TREES_FILE,POSN,popFreq))
+	f.close()
+	subprocess.check_call([sys.executable,os.path.join(ROOT,'clues_batch.py'),manifest,conditionalTrans,SITES_FILE,
+		'-o',out,'--thin','50','--noAncientHap'] + options,stdout=subprocess.DEVNULL)
+	lines = [line.rstrip('\n').split('\t') for line in open(out,'r')]
+	return [dict(zip(lines[0],line)) for line in lines[1:]]
+
+@pytest.mark.parametrize('options',[[],['--bothBins']])
+def test_missing_bins_give_nan_rows(conditional_trans,trees,carriers,tmp_path,options):
+	## the conditional file only has bins 33 and 34; 0.3 is in another
+	popFreqs = [0.3,POP_FREQ]
+	table = run_batch(conditional_trans,popFreqs,tmp_path,options=options)
+	assert [float(row['popFreq']) for row in table] == popFreqs
+	assert np.isnan(float(table[0]['logLR']))
+	derInds,ancInds,ancHap = carriers
+	engine = CluesEngine(conditional_trans)
+	res = engine.score(trees,derInds,ancInds,ancHap,discretizedPopFreqIdx=BIN,marginals='none')
+	engine.close()
+	assert np.isclose(float(table[1]['logLR']),res['logLikelihoodRatios'][res['iHat'],res['jHat']],rtol=0,atol=1e-5)
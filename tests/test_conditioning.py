@@ -0,0 +1,85 @@
+import glob
+import os
+
+import h5py
+import numpy as np
+
+import transition_store
+from conftest import LOG_FILE,SMALL_BIN
+
+def load_mats(path):
+	f = h5py.File(path,'r')
+	mats = dict([(name,np.array(f[name])) for name in f.keys()])
+	s = f.attrs['s']
+	f.close()
+	return mats,s
+
+def condition_one_bin(mats,neuMats,discretizedPopFreqIdx,I_SEL,AW_TIMES):
+	## element by element, as conditional_transition_matrices.py used to
+	NG = np.array(mats['P0']).shape[0]
+	data = np.zeros((len(I_SEL),len(AW_TIMES) - 1,NG,NG))
+	for (ii_sel,i_sel) in enumerate(I_SEL):
+		for i_dt in range(len(AW_TIMES) - 1):
+			src = neuMats if i_dt > i_sel else mats
+			mat = np.log(transition_store.clean_trans_mat(np.array(src['P'+str(i_dt)])))
+			if i_dt > 0:
+				nextTimeRemainingTrans = transition_store.logdotexp(mat,timeRemainingTrans)
+			else:
+				timeRemainingTrans = mat
+			for i_f0 in range(NG):
+				for i_f1 in range(NG):
+					if i_dt == 0:
+						data[ii_sel,i_dt,i_f0,i_f1] = 0 if i_f1 == discretizedPopFreqIdx else -np.inf
+						continue
+					val = mat[i_f0,i_f1] + timeRemainingTrans[i_f1,discretizedPopFreqIdx] - nextTimeRemainingTrans[i_f0,discretizedPopFreqIdx]
+					data[ii_sel,i_dt,i_f0,i_f1] = val if np.isfinite(val) else -np.inf
+			if i_dt > 0:
+				timeRemainingTrans = nextTimeRemainingTrans
+	return data
+
+def assert_same(x,y):
+	assert np.array_equal(np.isfinite(x),np.isfinite(y))
+	assert np.allclose(x[np.isfinite(x)],y[np.isfinite(y)],rtol=0,atol=1e-10)
+
+def test_vectorized_conditioning_matches_elementwise(small_trans_dir):
+	files = sorted(glob.glob(os.path.join(small_trans_dir,'*.h5')),key=lambda h5: load_mats(h5)[1])
+	neuMats,_ = load_mats(files[0])
+	mats,s = load_mats(files[2])
+	AW_TIMES,_ = transition_store.parse_log_file(LOG_FILE)
+	I_SEL = [3,len(AW_TIMES) - 2]
+	with np.errstate(divide='ignore',invalid='ignore'):
+		data,_ = transition_store.condition_trans_mats(mats,neuMats,s,[SMALL_BIN],I_SEL,AW_TIMES,ssv=True)
+		assert_same(data[0],condition_one_bin(mats,neuMats,SMALL_BIN,I_SEL,AW_TIMES))
+
+def test_all_bins_in_one_pass_match_bin_by_bin(small_trans_dir):
+	store = transition_store.TransDirTransitionStore(small_trans_dir,LOG_FILE,ssv=True,tSelMax=2000)
+	mats = store.matrices()
+	I_SEL = list(store.attrs['iSel'])
+	AW_TIMES = store.attrs['t']
+	bins = [5,SMALL_BIN,SMALL_BIN+1]
+	with np.errstate(divide='ignore',invalid='ignore'):
+		for k in range(len(mats)):
+			data,logStatDistn = transition_store.condition_trans_mats(mats[k],mats[0],store.attrs['sGrid'][k],bins,I_SEL,AW_TIMES,ssv=True)
+			for (i_d,discretizedPopFreqIdx) in enumerate(bins):
+				one,oneStatDistn = transition_store.condition_trans_mats(mats[k],mats[0],store.attrs['sGrid'][k],[discretizedPopFreqIdx],I_SEL,AW_TIMES,ssv=True)
+				assert_same(data[i_d],one[0])
+				assert np.array_equal(logStatDistn,oneStatDistn)
+
+def test_stat_distn_follows_s_grid(small_trans_dir,small_conditional_trans):
+	## glob lists the s files in directory order, not sGrid order
+	store = transition_store.TransDirTransitionStore(small_trans_dir,LOG_FILE)
+	with h5py.File(small_conditional_trans,'r') as f:
+		assert np.array_equal(f.attrs['sGrid'],store.attrs['sGrid'])
+		assert_same(f['stat_distn'][:],store.stat_distn())
+
+def test_trans_dir_store_keeps_the_last_bins(small_trans_dir):
+	store = transition_store.TransDirTransitionStore(small_trans_dir,LOG_FILE)
+	first = np.array(store.dataset('trans_dpfi5'))
+	for discretizedPopFreqIdx in [6,7,6]:
+		store.dataset('trans_dpfi%d'%(discretizedPopFreqIdx))
+	assert list(store.BIN_CACHE) == [7,6]
+	## all the bins of one call are kept, however many
+	store.condition_bins([5,6,7])
+	assert sorted(store.BIN_CACHE) == [5,6,7]
+	assert np.array_equal(store.dataset('trans_dpfi5'),first)
+	store.close()
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import transition_store
+from clues_engine import CluesEngine
+from conftest import LOG_FILE,TRANS_DIR,SMALL_BIN,SMALL_POP_FREQ
+
+def test_built_matrices_match_the_grid(small_trans_dir,small_conditional_trans):
+	builder = transition_store.TransitionBuilder(LOG_FILE,small_trans_dir)
+	store = transition_store.open_store(small_conditional_trans)
+	for k in [1,2]:
+		data,_ = builder.conditional_trans(store.attrs['sGrid'][k],SMALL_BIN,store.attrs['t'])
+		ref = store.read_block(SMALL_BIN,[k],[0])
+		assert np.array_equal(np.isfinite(data),np.isfinite(ref))
+		assert np.allclose(data[np.isfinite(data)],ref[np.isfinite(ref)],rtol=0,atol=1e-8)
+	store.close()
+
+def test_mu_is_read_from_the_matrices(small_trans_dir):
+	builder = transition_store.TransitionBuilder(LOG_FILE,small_trans_dir)
+	assert np.isclose(builder.parsed['mu'],6.25e-7)
+	assert np.isclose(transition_store.TransitionBuilder(LOG_FILE,small_trans_dir,mu=6.25e-7).parsed['mu'],6.25e-7)
+	with pytest.raises(ValueError):
+		transition_store.TransitionBuilder(LOG_FILE,small_trans_dir,mu=2.5e-8)
+	## the example trans_dir/ was not made with the mu of the example log
+	assert np.isclose(transition_store.TransitionBuilder(LOG_FILE,TRANS_DIR).parsed['mu'],2.5e-8)
+
+def test_continuous_s(small_trans_dir,small_conditional_trans,trees,carriers):
+	derInds,ancInds,ancHap = carriers
+	engine = CluesEngine(small_conditional_trans,sampleBatch=0,transBuilder=transition_store.TransitionBuilder(LOG_FILE,small_trans_dir))
+	res = engine.score(trees,derInds,ancInds,ancHap,popFreq=SMALL_POP_FREQ,marginals='none',continuousS=True)
+	engine.close()
+	sGrid = list(res['sGrid'])
+	i = sGrid.index(res['sHat'])
+	assert sGrid[max(i-1,0)] <= res['sHatContinuous'] <= sGrid[min(i+1,len(sGrid)-1)]
+	assert res['logLRContinuous'] >= np.max(res['logLikelihoodRatios']) - 1e-6
+	## the grid points the optimizer tries match the grid's log-LRs
+	for (s,logLR) in res['sEvaluations']:
+		if s in sGrid:
+			assert np.isclose(logLR,res['logLikelihoodRatios'][sGrid.index(s),0])
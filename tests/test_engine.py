@@ -0,0 +1,182 @@
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+from clues_engine import CluesEngine,importance_diagnostics
+from conftest import ROOT,POSN,POP_FREQ,BIN,LOG_FILE,TRANS_DIR
+
+KEYS = ['logLikelihoodRatios','logImportanceWeights','xMargs']
+
+def score(engine,trees,carriers,**kwargs):
+	derInds,ancInds,ancHap = carriers
+	if 'popFreq' not in kwargs:
+		kwargs['discretizedPopFreqIdx'] = BIN
+	res = engine.score(trees,derInds,ancInds,ancHap,**kwargs)
+	engine.close()
+	return res
+
+def assert_same(res,ref,keys=KEYS):
+	for key in keys:
+		x = np.asarray(res[key],dtype=float)
+		y = np.asarray(ref[key],dtype=float)
+		assert np.array_equal(np.isfinite(x),np.isfinite(y)),key
+		assert np.allclose(x[np.isfinite(x)],y[np.isfinite(y)],rtol=0,atol=1e-9),key
+	assert res['sHat'] == ref['sHat']
+
+@pytest.fixture(scope='module')
+def serial(conditional_trans,trees,carriers):
+	return score(CluesEngine(conditional_trans),trees,carriers)
+
+def test_cli_matches_engine(conditional_trans,serial,tmp_path):
+	out = str(tmp_path.joinpath('site'))
+	subprocess.check_call([sys.executable,os.path.join(ROOT,'clues.py'),os.path.join(ROOT,'example','example.trees'),
+		conditional_trans,os.path.join(ROOT,'example','example.sites'),str(POP_FREQ),'--posn',str(POSN),
+		'--thin','50','--noAncientHap','-o',out],stdout=subprocess.DEVNULL)
+	f = h5py.File(out + '.h5','r')
+	assert_same(dict([(key,np.array(f[key])) for key in KEYS] + [('sHat',f.attrs['sHat'])]),serial)
+	f.close()
+
+@pytest.mark.parametrize('sampleBatch',[4,0])
+def test_batches_match_serial(conditional_trans,trees,carriers,serial,sampleBatch):
+	assert_same(score(CluesEngine(conditional_trans,sampleBatch=sampleBatch),trees,carriers),serial)
+
+def test_workers_match_serial(conditional_trans,trees,carriers,serial):
+	assert_same(score(CluesEngine(conditional_trans,sampleBatch=3,workers=2),trees,carriers),serial)
+
+@pytest.mark.parametrize('options',[{},{'sampleBatch':1},{'sampleBatch':3,'workers':2}])
+def test_lazy_trans_matches_serial(conditional_trans,trees,carriers,serial,options):
+	assert_same(score(CluesEngine(conditional_trans,lazyTrans=True,**options),trees,carriers),serial)
+
+def test_lazy_trans_keeps_one_chunk(conditional_trans):
+	engine = CluesEngine(conditional_trans,lazyTrans=True)
+	assert engine.sampleBatch > 1
+	trans,_,_ = engine.sampling_trans(BIN)
+	full = trans.read_all()
+	assert trans.epochsPerRead > 1
+	for i in list(range(trans.shape[2])) + list(range(trans.shape[2]-1,-1,-1)):
+		assert np.array_equal(trans[...,i,:,:],full[:,:,i])
+		assert trans.slabStart == i - i % trans.epochsPerRead
+		assert trans.slab.shape[2] <= trans.epochsPerRead
+	engine.close()
+
+@pytest.fixture(scope='module')
+def npy_store(conditional_trans,tmp_path_factory):
+	out = str(tmp_path_factory.mktemp('npy').joinpath('store'))
+	subprocess.check_call([sys.executable,os.path.join(ROOT,'convert_transition_store.py'),conditional_trans,out])
+	return out
+
+def test_npy_store_matches_serial(npy_store,trees,carriers,serial):
+	assert_same(score(CluesEngine(npy_store),trees,carriers),serial)
+
+def test_npy_store_reads_views(npy_store):
+	engine = CluesEngine(npy_store)
+	trans,_,_ = engine.sampling_trans(BIN)
+	## a slice of the memory map, not a private copy
+	assert not trans.flags['OWNDATA']
+	assert isinstance(trans.base,np.memmap) or isinstance(trans,np.memmap)
+	engine.close()
+
+def test_marginals_best_and_none(conditional_trans,trees,carriers,serial):
+	best = score(CluesEngine(conditional_trans),trees,carriers,marginals='best')
+	assert_same(best,serial)
+	assert np.allclose(best['xHat'],serial['xHat'])
+	none = score(CluesEngine(conditional_trans),trees,carriers,marginals='none')
+	assert_same(none,serial,keys=KEYS[:2])
+	assert len(none['xMargs']) == 0
+	## no second pass below margThreshold
+	skipped = score(CluesEngine(conditional_trans),trees,carriers,marginals='best',margThreshold=np.max(serial['logLikelihoodRatios'])+1)
+	assert_same(skipped,serial,keys=KEYS[:2])
+	assert len(skipped['xMargs']) == 0
+
+def test_checkpoint_resume(conditional_trans,trees,carriers,serial,tmp_path):
+	checkpoint = str(tmp_path.joinpath('site.ckpt.h5'))
+	part = score(CluesEngine(conditional_trans),trees[:4],carriers,checkpoint=checkpoint,checkpointEvery=2)
+	assert part['numImportanceSamples'] == 4
+	## the checkpointed samples are not read again
+	resumed = ['not a tree']*4 + trees[4:]
+	assert_same(score(CluesEngine(conditional_trans),resumed,carriers,checkpoint=checkpoint,checkpointEvery=2),serial)
+
+def test_checkpoint_refuses_other_settings(conditional_trans,trees,carriers,tmp_path):
+	checkpoint = str(tmp_path.joinpath('site.ckpt.h5'))
+	score(CluesEngine(conditional_trans),trees[:4],carriers,checkpoint=checkpoint,checkpointInfo={'treesFile':'a.trees'})
+	with pytest.raises(ValueError):
+		score(CluesEngine(conditional_trans),trees,carriers,checkpoint=checkpoint,checkpointInfo={'treesFile':'b.trees'})
+
+@pytest.mark.parametrize('options',[{'marginals':'best'},{'coarseStep':3},{'checkpoint':'unused.h5'}])
+def test_multi_pass_needs_reiterable_samples(conditional_trans,trees,carriers,options):
+	with pytest.raises(TypeError):
+		score(CluesEngine(conditional_trans),iter(trees),carriers,**options)
+
+def test_adaptive_stopping(conditional_trans,trees,carriers,serial):
+	## any ESS >= 1, so scoring stops after minSamples
+	early = score(CluesEngine(conditional_trans),trees,carriers,essTol=1,minSamples=3)
+	assert early['numImportanceSamples'] == 3
+	assert_same(early,score(CluesEngine(conditional_trans),trees[:3],carriers))
+	## tolerances that are never met score every sample
+	full = score(CluesEngine(conditional_trans),trees,carriers,essTol=len(trees)+1,seTol=0)
+	assert full['numImportanceSamples'] == len(trees)
+	assert_same(full,serial)
+
+def test_importance_diagnostics():
+	logWeights = np.log([1.,2.,3.,4.])
+	ess,se = importance_diagnostics(logWeights)
+	assert np.isclose(ess,10.**2/30)
+	assert np.isclose(se,np.sqrt(1/ess - 1/4.))
+	assert np.isclose(importance_diagnostics(np.zeros(5))[0],5)
+
+@pytest.mark.parametrize('coarseStep',[2,5])
+def test_coarse_search_finds_the_same_sHat(conditional_trans,trees,carriers,serial,coarseStep):
+	res = score(CluesEngine(conditional_trans),trees,carriers,coarseStep=coarseStep)
+	assert res['sHat'] == serial['sHat']
+	assert np.allclose(res['xHat'],serial['xHat'])
+	evaluated = np.asarray(res['gridEvaluated'],dtype=bool)
+	assert 0 < np.sum(evaluated) < evaluated.size
+	lr = np.asarray(res['logLikelihoodRatios'])
+	assert np.allclose(lr[evaluated],np.asarray(serial['logLikelihoodRatios'])[evaluated])
+	assert np.all(np.isneginf(lr[~evaluated]))
+
+def test_coarse_search_ssv(trees,carriers):
+	derInds,ancInds,ancHap = carriers
+	engine = CluesEngine(TRANS_DIR,transDirLog=LOG_FILE,transDirSsv=True,transDirTSelMax=1000,sampleBatch=0)
+	full = engine.score(trees[:5],derInds,ancInds,ancHap,discretizedPopFreqIdx=BIN,ssv=True,marginals='none')
+	res = engine.score(trees[:5],derInds,ancInds,ancHap,discretizedPopFreqIdx=BIN,ssv=True,marginals='none',coarseStep=4)
+	engine.close()
+	assert (res['sHat'],res['tHat']) == (full['sHat'],full['tHat'])
+	evaluated = np.asarray(res['gridEvaluated'],dtype=bool)
+	assert np.allclose(np.asarray(res['logLikelihoodRatios'])[evaluated],np.asarray(full['logLikelihoodRatios'])[evaluated])
+
+@pytest.fixture(scope='module')
+def trans_dir_engines():
+	## one per statDistn setting, kept open so the bins are conditioned once
+	engines = dict([(statDistn,CluesEngine(TRANS_DIR,statDistn=statDistn,transDirLog=LOG_FILE)) for statDistn in [False,True]])
+	yield engines
+	for engine in engines.values():
+		engine.close()
+
+@pytest.mark.parametrize('statDistn',[False,True])
+def test_trans_dir_matches_conditional_file(conditional_trans,trans_dir_engines,trees,carriers,statDistn):
+	derInds,ancInds,ancHap = carriers
+	ref = score(CluesEngine(conditional_trans,statDistn=statDistn),trees,carriers)
+	res = trans_dir_engines[statDistn].score(trees,derInds,ancInds,ancHap,discretizedPopFreqIdx=BIN)
+	assert_same(res,ref)
+
+@pytest.mark.parametrize('statDistn',[False,True])
+def test_both_bins_mixes_the_bins(conditional_trans,trans_dir_engines,trees,carriers,statDistn):
+	## popFreq between bins 33 and 34, both in the conditional file
+	popFreq = 0.775
+	derInds,ancInds,ancHap = carriers
+	engine = CluesEngine(conditional_trans,statDistn=statDistn)
+	(lo,hi),(wLo,wHi) = engine.neighbouring_bins(popFreq)
+	assert (lo,hi) == (BIN,BIN+1)
+	resLo = engine.score(trees,derInds,ancInds,ancHap,discretizedPopFreqIdx=lo,marginals='none')
+	resHi = engine.score(trees,derInds,ancInds,ancHap,discretizedPopFreqIdx=hi,marginals='none')
+	res = score(engine,trees,carriers,popFreq=popFreq,bothBins=True)
+	assert list(res['popFreqBins']) == [lo,hi]
+	assert np.allclose(res['popFreqBinWeights'],[wLo,wHi])
+	mix = np.logaddexp(np.log(wLo) + np.asarray(resLo['logImportanceWeights']),np.log(wHi) + np.asarray(resHi['logImportanceWeights']))
+	assert_same({'logImportanceWeights':mix,'sHat':res['sHat']},res,keys=['logImportanceWeights'])
+	assert_same(trans_dir_engines[statDistn].score(trees,derInds,ancInds,ancHap,popFreq=popFreq,bothBins=True),res)
@@ -0,0 +1,83 @@
+import numpy as np
+
+import clues_utils
+from clues_engine import CluesEngine
+
+def finite_equal(x,y,rtol=1e-7):
+	## same -inf/nan pattern, and close where finite
+	x = np.asarray(x,dtype=float)
+	y = np.asarray(y,dtype=float)
+	assert np.array_equal(np.isfinite(x),np.isfinite(y))
+	assert np.allclose(x[np.isfinite(x)],y[np.isfinite(y)],rtol=rtol,atol=1e-10)
+
+def test_emission_rows_match_structured_coal(conditional_trans):
+	engine = CluesEngine(conditional_trans)
+	rng = np.random.RandomState(0)
+	for e in [0,5,12,len(engine.ds)-1]:
+		## (der, anc, mix) counts at the start and end of the epoch
+		C0 = np.stack([rng.randint(0,12,size=40),rng.randint(1,12,size=40),rng.randint(1,20,size=40)],axis=1)
+		C1 = np.maximum(C0 - rng.randint(0,4,size=C0.shape),np.minimum(C0,1))
+		C1[::5,2] = C1[::5,1]
+		isTavare = e+1 > engine.GRIFFITHS_TAVARE_CHANGEPOINT
+		scalar = [[clues_utils.tavare_structured_coal(c0[0],c1[0],c0[1],c1[1],c0[2],c1[2],engine.popsize[e],x,engine.ds[e],isTavare)
+			for x in engine.FREQS] for (c0,c1) in zip(C0,C1)]
+		finite_equal(engine.log_emission_vector(e,C0,C1),scalar,rtol=1e-6)
+		## rows are stored once per (a, b)
+		for l in range(3):
+			assert len(engine.EMISSION_ROWS[(l,e)]) == len(engine.EMISSION_INDEX[(l,e)]) + 1
+	engine.close()
+
+def test_tavare_array_matches_scalar():
+	a,b = np.meshgrid(np.arange(1,30),np.arange(1,30),indexing='ij')
+	a = a.ravel()
+	b = b.ravel()
+	for (t,n) in [(50.,1e4),(1000.,5e3),(20000.,1e4)]:
+		scalar = [clues_utils.tavare_log_prob_coal_counts(int(ai),int(bi),t,n) for (ai,bi) in zip(a,b)]
+		scalar = [v if np.isfinite(v) and bi <= ai else -np.inf for (v,ai,bi) in zip(scalar,a,b)]
+		finite_equal(clues_utils.tavare_log_prob_coal_counts_array(a,b,t,n),scalar,rtol=1e-6)
+
+def test_log_coal_count_rows_matches_scalar():
+	N = 1e4*np.array([0.1,0.5,0.9])
+	a = np.array([2,5,12,12])
+	b = np.array([1,3,12,4])
+	for isTavare in [True,False]:
+		rows = clues_utils.log_coal_count_rows(a,b,300.,N,isTavare)
+		assert rows.shape == (len(a),len(N))
+		log_prob = clues_utils.tavare_log_prob_coal_counts if isTavare else clues_utils.griffiths_log_prob_coal_counts
+		scalar = [[log_prob(ai,bi,300.,Nv) for Nv in N] for (ai,bi) in zip(a,b)]
+		finite_equal(rows,np.where(np.isfinite(scalar),scalar,-np.inf),rtol=1e-6)
+
+def test_griffiths_array_matches_scalar():
+	a = np.repeat(np.arange(40,120,7),3)
+	b = a - np.tile([0,5,20],len(a)//3)
+	for (t,N) in [(100.,1e4),(400.,2e3)]:
+		scalar = [clues_utils.griffiths_log_prob_coal_counts(int(ai),int(bi),t,N) for (ai,bi) in zip(a,b)]
+		finite_equal(clues_utils.griffiths_log_prob_coal_counts_array(a,b,t,N),scalar)
+
+def test_branch_counts_array_matches_scalar():
+	rng = np.random.RandomState(0)
+	timePts = np.array([0.,10.,50.,100.,500.,1000.,5000.])
+	trees = [np.sort(rng.choice(timePts[1:],size=c).astype(float) + rng.choice([0,0.5],size=c)) for c in [1,4,9,9]]
+	coalTimes = np.full((len(trees),9),np.inf)
+	for (k,times) in enumerate(trees):
+		coalTimes[k,:len(times)] = times
+	for eps in [1e-10,1]:
+		counts = clues_utils.branch_counts_array(coalTimes,timePts,eps=eps)
+		for (k,times) in enumerate(trees):
+			C = clues_utils.branch_counts(times,timePts,eps=eps)[1:]
+			assert list(counts[k,:len(C)]) == C
+			assert np.all(counts[k,len(C):] == 1)
+
+def test_accumulated_marginals_match_one_sum(conditional_trans):
+	engine = CluesEngine(conditional_trans)
+	rng = np.random.RandomState(1)
+	## (samples, s, t_sel, epochs, NG) marginals and (s, t_sel, samples) weights
+	margEsts = rng.normal(size=(9,3,2,4,5))
+	logWeights = rng.normal(size=(3,2,9))
+	polarized = rng.rand(9) < 0.7
+	margAcc = None
+	for k in range(0,9,4):
+		margAcc = engine.accumulate_marginals(margAcc,margEsts[k:k+4],logWeights[...,k:k+4],polarized[k:k+4])
+	weighted = margEsts + np.moveaxis(logWeights,-1,0)[...,np.newaxis,np.newaxis]
+	assert np.allclose(margAcc,np.log(np.sum(np.exp(weighted[polarized]),axis=0)))
+	engine.close()
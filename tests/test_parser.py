@@ -0,0 +1,24 @@
+from io import StringIO
+
+import numpy as np
+import pytest
+
+import clues_utils
+
+Phylo = pytest.importorskip('Bio.Phylo')
+
+def bio_coal_times(nwk,removeSet):
+	## what clues did before the newick parser: prune with Bio.Phylo
+	tree = Phylo.read(StringIO(nwk),'newick')
+	for ind in set(removeSet):
+		tree.prune(ind)
+	return np.sort(clues_utils.coal_times(tree.clade.clades))
+
+def test_coal_times_by_class_matches_bio_phylo(trees,carriers):
+	derInds,ancInds,ancHap = carriers
+	ancHap = [] if ancHap is None else list(ancHap)
+	removeSets = [ancInds + ancHap,derInds + ancHap,derInds[1:] + ancHap,ancHap,
+		ancInds[:5] + derInds[3:9]]
+	for nwk in trees:
+		for (removeSet,times) in zip(removeSets,clues_utils.coal_times_by_class(nwk,removeSets)):
+			assert np.array_equal(times,bio_coal_times(nwk,removeSet))
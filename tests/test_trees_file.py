@@ -0,0 +1,26 @@
+import gzip
+import os
+import shutil
+
+import clues_utils
+from conftest import ROOT
+
+TREES_FILE = os.path.join(ROOT,'example','example.trees')
+
+def test_gzipped_trees_file_matches_plain(tmp_path):
+	gzFile = str(tmp_path.joinpath('example.trees.gz'))
+	with open(TREES_FILE,'rb') as fin, gzip.open(gzFile,'wb') as fout:
+		shutil.copyfileobj(fin,fout)
+	## what clues read before streaming: every sample line, then [burnin::thin]
+	lines = [line for line in open(TREES_FILE) if line[0] not in '#RN']
+	expected = [line.rstrip().split()[-1] for line in lines[7::13]]
+	for path in [TREES_FILE,gzFile]:
+		samples = clues_utils.read_tree_samples(path,burnin=7,thin=13)
+		assert list(samples) == expected
+		assert list(samples) == expected
+		assert samples.count() == len(expected)
+
+def test_seeded_order_is_fixed():
+	samples = clues_utils.read_tree_samples(TREES_FILE,thin=20,seed=3)
+	assert list(samples) == list(samples)
+	assert sorted(samples) == sorted(clues_utils.read_tree_samples(TREES_FILE,thin=20))
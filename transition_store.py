@@ -0,0 +1,492 @@
+from __future__ import division
+import numpy as np
+import h5py
+import json
+import os
+import glob
+import collections
+
+def index_runs(idxs,size):
+	'''
+	Splits a list of indices into runs of consecutive indices, returned as
+	(start,stop) pairs, so each run can be read as one contiguous hyperslab.
+	Negative indices count from the end, as in numpy.
+	'''
+	runs = []
+	for i in idxs:
+		i = int(i)
+		if i < 0:
+			i += size
+		if len(runs) > 0 and runs[-1][1] == i:
+			runs[-1][1] = i+1
+		else:
+			runs.append([i,i+1])
+	return [tuple(run) for run in runs]
+
+def clean_trans_mat(mat):
+	for (i,row) in enumerate(mat):
+		row[row<=0] = 0
+		row = row/np.sum(row)
+		mat[i,:] = row
+	return mat
+
+def logdotexp(A, B):
+	max_A = np.max(A)
+	max_B = np.max(B)
+	C = np.dot(np.exp(A - max_A), np.exp(B - max_B))
+	np.log(C, out=C)
+	C += max_A + max_B
+	return C
+
+def condition_trans_mats(mats,neuMats,s,discretizedPopFreqIdxs,I_SEL,AW_TIMES,ssv=False,debug=False):
+	'''
+	Conditions the matrices of one s on every bin in discretizedPopFreqIdxs
+	and SSV start in I_SEL, sharing the matrix products between bins. Returns
+	the (bins, t_sel, epochs, NG, NG) log tensor and (t_sel, NG) stat_distn.
+	'''
+	dpfis = [int(_) for _ in discretizedPopFreqIdxs]
+	NG = np.array(mats['P0']).shape[0]
+	data = np.zeros((len(dpfis),len(I_SEL),len(AW_TIMES) - 1,NG,NG))
+	logStatDistn = np.zeros((len(I_SEL),NG))
+	for ii_sel,i_sel in enumerate(I_SEL):
+		if debug:
+			print('Computing s = %.4f,\t SSV @ %d'%(s,AW_TIMES[i_sel]))
+		stat_distn_mat = np.log(np.eye(NG))
+		stat_distn_mat[np.isnan(stat_distn_mat)] = -np.inf
+		for (i_dt,dt) in enumerate(np.diff(AW_TIMES)):
+			if i_dt > i_sel:
+				if not ssv:
+					print("WRONG")
+				mat = np.log(clean_trans_mat(np.array(neuMats['P'+str(i_dt)])))
+			else:
+				mat = np.log(clean_trans_mat(np.array(mats['P'+str(i_dt)])))
+			stat_distn_mat = logdotexp(mat,stat_distn_mat)
+			if i_dt == 0:
+				timeRemainingTrans = mat
+				## the present epoch ends in the conditioned bin
+				data[:,ii_sel,i_dt,:,:] = -np.inf
+				for (i_d,discretizedPopFreqIdx) in enumerate(dpfis):
+					data[i_d,ii_sel,i_dt,:,discretizedPopFreqIdx] = 0
+			else:
+				nextTimeRemainingTrans = logdotexp(mat,timeRemainingTrans)
+				#CONDITIONAL ON PRESENT FREQ (bins x f0 x f1):
+				cond = mat[np.newaxis,:,:] + timeRemainingTrans[:,dpfis].T[:,np.newaxis,:] - nextTimeRemainingTrans[:,dpfis].T[:,:,np.newaxis]
+				cond[np.isinf(cond) | np.isnan(cond)] = -np.inf
+				data[:,ii_sel,i_dt,:,:] = cond
+				timeRemainingTrans = nextTimeRemainingTrans
+			if debug:
+				print(data[:,ii_sel,i_dt,:,:])
+		vec = -np.inf*np.ones(NG)
+		vec[0] = 0
+		logStatDistn[ii_sel,:] = logdotexp(vec,stat_distn_mat)
+	return data,logStatDistn
+
+def parse_log_file(logFile,noSkip=False):
+	## this step is crucial because it parameterizes the discrete-time model.
+	## It returns:
+	#		AW_TIMES (time discretization used by argweaver and clues)
+	#		SAMPLING_POPSIZE (popsize used by argweaver)
+	if logFile == '':
+		## if no log file, we hard-code a default discretization (note this may be simply wrong
+		AW_TIMES = np.array([0.000000,62.378528,163.667865,328.140000,595.207431,1028.867597,1733.038592,2876.461093,4733.133724,7747.971422,12643.420512,20592.578708,33500.304814,54459.680528,88493.206395,143756.344893,233491.815987,379202.953491,615806.554427,1000000.000000])
+		SAMPLING_POPSIZE = np.array([10**4 for _ in AW_TIMES])
+	else:	
+		parsingPopsize = False
+		for line in open(logFile,'r'):
+			if len(line.split()) == 0:
+				continue
+			if line.split()[0] == 'times':
+				AW_TIMES = np.array([float(x) for x in line.split()[2][1:][:-1].split(',')])
+			if line.split()[0] == 'popsizes':
+				parsingPopsize = True
+				SAMPLING_POPSIZE = []
+				if line.rstrip()[-1] == ']':
+					SAMPLING_POPSIZE = np.array([float(x) for x in line.split()[2][1:][:-1].split(',')])
+					break
+				else:
+					SAMPLING_POPSIZE = [float(line.split('[')[1].split(',')[0])]
+					continue
+			if parsingPopsize:
+				SAMPLING_POPSIZE.append(float(line.rstrip()[:-1]))
+				if line.rstrip()[-1] == ']':
+					break
+		SAMPLING_POPSIZE = SAMPLING_POPSIZE[::(2-int(noSkip))]
+	return AW_TIMES,SAMPLING_POPSIZE
+
+class TransitionStore(object):
+	'''
+	Common reader for conditional transition stores: trans_dpfi%d is read as
+	contiguous (s, t_sel) hyperslabs, counted in bytesRead. Subclasses provide
+	attrs and dataset(name); cachesTrans stores keep their tensors in memory.
+	'''
+	cachesTrans = False
+
+	def stat_distn(self):
+		return self.dataset('stat_distn')
+
+	def trans_shape(self,discretizedPopFreqIdx):
+		return self.dataset('trans_dpfi%d'%(discretizedPopFreqIdx)).shape
+
+	def has_bin(self,discretizedPopFreqIdx):
+		## whether trans_dpfi%d is in the store
+		try:
+			self.dataset('trans_dpfi%d'%(discretizedPopFreqIdx))
+		except KeyError:
+			return False
+		return True
+
+	def read_block(self,discretizedPopFreqIdx,I_S,I_SEL,epochs=slice(None)):
+		'''
+		Reads trans_dpfi[I_S,I_SEL,epochs,:,:] with one hyperslab per run of
+		consecutive (s, t_sel) indices
+		'''
+		dset = self.dataset('trans_dpfi%d'%(discretizedPopFreqIdx))
+		rows = []
+		for (s0,s1) in index_runs(I_S,dset.shape[0]):
+			cols = []
+			for (t0,t1) in index_runs(I_SEL,dset.shape[1]):
+				slab = np.array(dset[s0:s1,t0:t1,epochs,:,:])
+				self.bytesRead += slab.nbytes
+				cols.append(slab)
+			rows.append(np.concatenate(cols,axis=1))
+		return np.concatenate(rows,axis=0)
+
+	def read_trans(self,discretizedPopFreqIdx,I_S,I_SEL,lazy=False):
+		'''
+		Transition tensor (s, t_sel, epochs, NG, NG) for the given grid
+		points. With lazy, epochs are read one at a time, as the recursions
+		first need them.
+		'''
+		if lazy:
+			return EpochSlabTrans(self,discretizedPopFreqIdx,I_S,I_SEL)
+		return self.read_block(discretizedPopFreqIdx,I_S,I_SEL)
+
+class HDF5TransitionStore(TransitionStore):
+	'''
+	Conditional transition file written by conditional_transition_matrices.py
+	(gzip-compressed datasets in one .hdf5 file)
+	'''
+
+	def __init__(self,path):
+		self.path = path
+		self.h5 = h5py.File(path,'r')
+		self.attrs = self.h5.attrs
+		self.bytesRead = 0
+
+	def __getstate__(self):
+		## reopened on first use after unpickling (e.g. in a --workers process)
+		state = self.__dict__.copy()
+		state['h5'] = None
+		state['attrs'] = None
+		return state
+
+	def dataset(self,name):
+		if self.h5 is None:
+			self.h5 = h5py.File(self.path,'r')
+			self.attrs = self.h5.attrs
+		return self.h5[name]
+
+	def close(self):
+		if self.h5 is not None:
+			self.h5.close()
+		return
+
+class NpyTransitionStore(TransitionStore):
+	'''
+	Directory of header.json and memory-mapped .npy datasets, written from an
+	.hdf5 file by convert_transition_store.py; reads are slices of the maps.
+	'''
+
+	def __init__(self,path):
+		self.path = path
+		header = json.load(open(os.path.join(path,NPY_STORE_HEADER),'r'))
+		self.attrs = dict([(key,np.array(val)) for (key,val) in header['attrs'].items()])
+		self.datasets = header['datasets']
+		self.MEMMAPS = {}
+		self.bytesRead = 0
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['MEMMAPS'] = {}
+		return state
+
+	def dataset(self,name):
+		if name not in self.MEMMAPS:
+			if name not in self.datasets:
+				raise KeyError('%s is not in %s'%(name,self.path))
+			self.MEMMAPS[name] = np.load(os.path.join(self.path,name+'.npy'),mmap_mode='r')
+		return self.MEMMAPS[name]
+
+	def read_block(self,discretizedPopFreqIdx,I_S,I_SEL,epochs=slice(None)):
+		## a slice of the memory map, not a copy, when the indices are runs, so
+		## the pages stay shared between processes
+		dset = self.dataset('trans_dpfi%d'%(discretizedPopFreqIdx))
+		sRuns = index_runs(I_S,dset.shape[0])
+		tRuns = index_runs(I_SEL,dset.shape[1])
+		if len(sRuns) == 1 and len(tRuns) == 1:
+			slab = dset[sRuns[0][0]:sRuns[0][1],tRuns[0][0]:tRuns[0][1],epochs]
+			self.bytesRead += slab.nbytes
+			return slab
+		return TransitionStore.read_block(self,discretizedPopFreqIdx,I_S,I_SEL,epochs=epochs)
+
+	def close(self):
+		self.MEMMAPS = {}
+		return
+
+class TransDirTransitionStore(TransitionStore):
+	'''
+	Unconditioned trans_dir/ matrices, conditioned in process on each bin
+	the first time it is asked for; only the last BIN_CACHE_SIZE bins are
+	kept (one bin of the SSV grid is about 280 MB)
+	'''
+	cachesTrans = True
+	BIN_CACHE_SIZE = 2
+
+	def __init__(self,path,logFile,noSkip=False,ssv=False,tSelMax=10000):
+		self.path = path
+		self.ssv = ssv
+		self.files = glob.glob(os.path.join(path,'*.h5'))
+		if len(self.files) == 0:
+			raise IOError('no transition matrix files in %s'%(path))
+		S_GRID = []
+		for h5 in self.files:
+			f = h5py.File(h5,'r')
+			S_GRID.append(f.attrs['s'])
+			FREQS = np.array(f.attrs['frequencies'])
+			f.close()
+		self.files = [self.files[i] for i in np.argsort(S_GRID)]
+		AW_TIMES,popsize = parse_log_file(logFile,noSkip=noSkip)
+		ds = np.diff(AW_TIMES)
+		if ssv:
+			I_SEL = [i for i in range(0,len(ds)-1) if AW_TIMES[i+1] < tSelMax] + [len(ds) - 1]
+		else:
+			I_SEL = [len(ds) - 1]
+		self.attrs = {'sGrid':np.sort(S_GRID),'iSel':np.array(I_SEL),'t':AW_TIMES,'freqs':FREQS,'popsize':np.array(popsize)}
+		self.MATS = None
+		self.BIN_CACHE = collections.OrderedDict()
+		self.STAT_DISTN = None
+		self.bytesRead = 0
+
+	def __getstate__(self):
+		## pool workers are given their transition tensors with the job
+		state = self.__dict__.copy()
+		state['MATS'] = None
+		state['BIN_CACHE'] = collections.OrderedDict()
+		return state
+
+	def matrices(self):
+		## binned matrices {'P0':...} of every s, in sGrid order
+		if self.MATS is None:
+			self.MATS = []
+			for h5 in self.files:
+				f = h5py.File(h5,'r')
+				self.MATS.append(dict([(name,np.array(f[name])) for name in f.keys()]))
+				f.close()
+		return self.MATS
+
+	def condition_bins(self,discretizedPopFreqIdxs):
+		'''
+		Conditions every s on the bins not yet in BIN_CACHE, sharing the
+		matrix products between them (and computes stat_distn on the way)
+		'''
+		dpfis = []
+		for discretizedPopFreqIdx in set([int(idx) for idx in discretizedPopFreqIdxs]):
+			if discretizedPopFreqIdx in self.BIN_CACHE:
+				## kept ahead of the bins conditioned now
+				self.BIN_CACHE[discretizedPopFreqIdx] = self.BIN_CACHE.pop(discretizedPopFreqIdx)
+			else:
+				dpfis.append(discretizedPopFreqIdx)
+		if len(dpfis) == 0 and self.STAT_DISTN is not None:
+			return
+		mats = self.matrices()
+		S_GRID = self.attrs['sGrid']
+		I_SEL = list(self.attrs['iSel'])
+		AW_TIMES = self.attrs['t']
+		NG = len(self.attrs['freqs'])
+		## one array per bin, so that dropping a bin frees it
+		data = [np.zeros((len(S_GRID),len(I_SEL),len(AW_TIMES) - 1,NG,NG)) for discretizedPopFreqIdx in dpfis]
+		logStatDistn = np.zeros((len(S_GRID),len(I_SEL),NG))
+		for (i_s,s) in enumerate(S_GRID):
+			sData,logStatDistn[i_s] = condition_trans_mats(mats[i_s],mats[0],s,dpfis,I_SEL,AW_TIMES,ssv=self.ssv)
+			for i_d in range(len(dpfis)):
+				data[i_d][i_s] = sData[i_d]
+		for (i_d,discretizedPopFreqIdx) in enumerate(dpfis):
+			self.BIN_CACHE[discretizedPopFreqIdx] = data[i_d]
+		## least recently used bins first
+		while len(self.BIN_CACHE) > max(self.BIN_CACHE_SIZE,len(set(discretizedPopFreqIdxs))):
+			self.BIN_CACHE.popitem(last=False)
+		self.STAT_DISTN = logStatDistn
+		return
+
+	def dataset(self,name):
+		if name == 'stat_distn':
+			self.condition_bins([])
+			return self.STAT_DISTN
+		if not name.startswith('trans_dpfi'):
+			raise KeyError('%s is not in %s'%(name,self.path))
+		discretizedPopFreqIdx = int(name[len('trans_dpfi'):])
+		self.condition_bins([discretizedPopFreqIdx])
+		return self.BIN_CACHE[discretizedPopFreqIdx]
+
+	def has_bin(self,discretizedPopFreqIdx):
+		## every bin can be conditioned
+		return 0 <= discretizedPopFreqIdx < len(self.attrs['freqs'])
+
+	def read_block(self,discretizedPopFreqIdx,I_S,I_SEL,epochs=slice(None)):
+		## a view into BIN_CACHE, not a copy, when the indices are runs
+		dset = self.dataset('trans_dpfi%d'%(discretizedPopFreqIdx))
+		sRuns = index_runs(I_S,dset.shape[0])
+		tRuns = index_runs(I_SEL,dset.shape[1])
+		if len(sRuns) == 1 and len(tRuns) == 1:
+			return dset[sRuns[0][0]:sRuns[0][1],tRuns[0][0]:tRuns[0][1],epochs]
+		return TransitionStore.read_block(self,discretizedPopFreqIdx,I_S,I_SEL,epochs=epochs)
+
+	def close(self):
+		self.MATS = None
+		self.BIN_CACHE = collections.OrderedDict()
+		return
+
+NPY_STORE_HEADER = 'header.json'
+
+def open_store(path,logFile=None,noSkip=False,ssv=False,tSelMax=10000):
+	'''
+	.npy store directories are recognized by their header.json; other
+	directories are trans_dir/s, conditioned at load time, which needs the
+	arg-sample logFile (see TransDirTransitionStore)
+	'''
+	if os.path.isdir(path):
+		if os.path.exists(os.path.join(path,NPY_STORE_HEADER)):
+			return NpyTransitionStore(path)
+		if logFile == None:
+			raise ValueError('%s has no %s: it is conditioned as a trans_dir/, which needs the arg-sample .log'%(path,NPY_STORE_HEADER))
+		return TransDirTransitionStore(path,logFile,noSkip=noSkip,ssv=ssv,tSelMax=tSelMax)
+	return HDF5TransitionStore(path)
+
+def hdf5_to_npy_store(hdf5File,outDir):
+	'''
+	Converts a conditional transition .hdf5 file to an NpyTransitionStore
+	directory; datasets are copied one leading slice at a time
+	'''
+	if not os.path.isdir(outDir):
+		os.makedirs(outDir)
+	f = h5py.File(hdf5File,'r')
+	attrs = {}
+	for key in ['sGrid','iSel','t','freqs','popsize']:
+		attrs[key] = np.array(f.attrs[key]).tolist()
+	names = sorted(f.keys())
+	for name in names:
+		dset = f[name]
+		out = np.lib.format.open_memmap(os.path.join(outDir,name+'.npy'),mode='w+',dtype=dset.dtype,shape=dset.shape)
+		for i in range(dset.shape[0]):
+			out[i] = dset[i]
+		out.flush()
+		del out
+	f.close()
+	json.dump({'attrs':attrs,'datasets':names},open(os.path.join(outDir,NPY_STORE_HEADER),'w'))
+	return
+
+class EpochSlabTrans(object):
+	'''
+	Transition tensor read lazily through trans[...,i,:,:], one chunk of epochs
+	at a time; only the last slab read is kept, so each slab is read about
+	twice per batch (backward pass up, forward pass down).
+	'''
+
+	def __init__(self,store,discretizedPopFreqIdx,I_S,I_SEL):
+		self.store = store
+		self.discretizedPopFreqIdx = discretizedPopFreqIdx
+		self.I_S = list(I_S)
+		self.I_SEL = list(I_SEL)
+		dset = store.dataset('trans_dpfi%d'%(discretizedPopFreqIdx))
+		self.shape = (len(self.I_S),len(self.I_SEL)) + tuple(dset.shape[2:])
+		self.ndim = len(self.shape)
+		chunks = getattr(dset,'chunks',None)
+		if chunks:
+			self.epochsPerRead = chunks[2]
+		else:
+			self.epochsPerRead = 1
+		self.slabStart = None
+		self.slab = None
+
+	def epoch(self,i):
+		start = i - i % self.epochsPerRead
+		if self.slabStart != start:
+			stop = min(start + self.epochsPerRead,self.shape[2])
+			self.slab = None
+			self.slab = self.store.read_block(self.discretizedPopFreqIdx,self.I_S,self.I_SEL,epochs=slice(start,stop))
+			self.slabStart = start
+		return self.slab[:,:,i-start]
+
+	def read_all(self):
+		return self.store.read_block(self.discretizedPopFreqIdx,self.I_S,self.I_SEL)
+
+	def __getitem__(self,key):
+		## only keys of the form (..., epoch, rows, cols) are supported
+		if not (isinstance(key,tuple) and len(key) == 4 and key[0] is Ellipsis):
+			raise NotImplementedError('EpochSlabTrans only supports trans[...,epoch,:,:]-style indexing')
+		return self.epoch(int(key[1]))[...,key[2],key[3]]
+
+class TransitionBuilder(object):
+	'''
+	Builds and conditions the transition tensor of any s for hard sweeps from
+	trans_dir/-style files, with their N, bins and mu; the matrices of the
+	last cacheSize values of s are kept.
+	'''
+
+	def __init__(self,argweaverLog,transMatsDir,mu=None,noSkip=False,cacheSize=8,debug=False):
+		## imported here: only needed for on-the-fly matrices
+		import make_transition_matrices_from_argweaver as mtm
+		self.mtm = mtm
+		self.pdebug = mtm.get_debug_print(debug)
+		self.parsed = mtm.parse_argweaver_log(argweaverLog,pdebug=self.pdebug)
+		files = sorted(glob.glob(os.path.join(transMatsDir,'*.h5')))
+		if len(files) == 0:
+			raise IOError('no transition matrix files in %s'%(transMatsDir))
+		f = h5py.File(files[0],'r')
+		self.N = int(f.attrs['N'])
+		## breaks is 0 for unbinned matrices
+		if np.ndim(f.attrs['breaks']) == 0:
+			self.breaks = None
+		else:
+			self.breaks = np.array(f.attrs['breaks'])
+		self.freqs = np.array(f.attrs['frequencies'])
+		## mu the matrices were made with, from the mutation probabilities v of
+		## their epochs (v is mu times N_aw/N in each epoch)
+		self.parsed['mu'] = 1.0
+		unitRates = mtm.epoch_parameters(self.N,0,self.parsed,noSkip=noSkip)[2]
+		if len([name for name in f.keys() if name[0] == 'P']) != len(unitRates):
+			raise ValueError('the matrices in %s do not match the epochs of %s (check --noSkip)'%(transMatsDir,argweaverLog))
+		fileMu = np.array([f['P%d'%(i)].attrs['v'] for i in range(len(unitRates))])/unitRates
+		f.close()
+		if not np.allclose(fileMu,fileMu[0]):
+			raise ValueError('the matrices in %s do not match the popsizes of %s'%(transMatsDir,argweaverLog))
+		if mu != None and not np.isclose(mu,fileMu[0]):
+			raise ValueError('mu = %g does not match the mutation rate %g the matrices in %s were made with'%(mu,fileMu[0],transMatsDir))
+		self.parsed['mu'] = fileMu[0]
+		self.noSkip = noSkip
+		self.cacheSize = cacheSize
+		self.MATS_CACHE = collections.OrderedDict()
+
+	def matrices(self,s):
+		## binned transition matrices {'P0':...} of s, as in a trans_dir/ file
+		if s in self.MATS_CACHE:
+			mats = self.MATS_CACHE.pop(s)
+		else:
+			mats = {}
+			for (i,(P,_,_,_)) in enumerate(self.mtm.iter_transition_matrices(self.N,s,self.parsed,noSkip=self.noSkip,pdebug=self.pdebug)):
+				if self.breaks is not None:
+					P = self.mtm.bin_matrix(P,self.breaks,False)
+				mats['P%d'%(i)] = np.array(P,dtype=np.float64)
+		self.MATS_CACHE[s] = mats
+		while len(self.MATS_CACHE) > self.cacheSize:
+			self.MATS_CACHE.popitem(last=False)
+		return mats
+
+	def conditional_trans(self,s,discretizedPopFreqIdx,AW_TIMES):
+		'''
+		(1, 1, epochs, NG, NG) log transition tensor of s conditioned on the
+		popFreq bin, and the (1, 1) log stationary probability of that bin
+		'''
+		I_SEL = [len(AW_TIMES) - 2]
+		data,logStatDistn = condition_trans_mats(self.matrices(s),None,s,[discretizedPopFreqIdx],I_SEL,AW_TIMES)
+		return data[0][np.newaxis],logStatDistn[np.newaxis,:,discretizedPopFreqIdx]